@@ -6,6 +6,9 @@ import gzip
 import io
 import re
 import pickle
+import atexit
+import logging
+import threading
 import pymongo
 import numpy as np
 
@@ -17,8 +20,8 @@ except:
 from datetime import date
 
 pid = os.getpid()
-start_memory = psutil.Process(pid).memory_info().rss
-print('\nSTART RSS memory use (GB): {}'.format(round(start_memory/1024/1024/1024,3)))
+proc = psutil.Process(pid)
+start_memory = proc.memory_info().rss
 
 # import my classes from src
 from src import extract_interpro   as interpro
@@ -46,60 +49,89 @@ chunk_size = 100000
 MONGO_HOST = None # insert your previously defined mongo host, e.g."10.1.0.202"
 MONGO_PORT = None # insert your previously defined mongo port, e.g. 30077
 
-# Define automatic logger
+# Define automatic logger, writing to the terminal and to a log file
 
-class Logger(object):
-	def __init__(self, name):
-		self.terminal = sys.stdout
-		self.log = open(name, "w")
+logfile = 'databases_extraction_{}_{}.log'.format(n_to_extract, date.today())
+
+log = logging.getLogger('dbuilder')
+log.setLevel(logging.INFO)
+log.addHandler(logging.StreamHandler(sys.__stdout__))
+# the log file is flushed after every line, so the progress lines are still there
+# if the run is killed
+log.addHandler(logging.FileHandler(logfile, 'w'))
+
+class PrintToLog(object):
+	"""Forwards the progress lines printed by the modules in src to the logger.
+	The modules also print from background threads (e.g. the mongo writers), and
+	print writes a line in several calls, so each thread builds its own pending 
+	line; the lines are only logged once complete.
+	"""
+	def __init__(self, logger):
+		self.logger = logger
+		self.lines = {}
+		self.lock = threading.Lock()
 
 	def write(self, message):
-		self.terminal.write(message)
-		self.log.write(message)  
+		with self.lock:
+			thread = threading.get_ident()
+			line = self.lines.pop(thread, '') + message
+			while '\n' in line:
+				done, line = line.split('\n', 1)
+				self.logger.info(done)
+			if len(line) > 0:
+				self.lines[thread] = line
 
 	def flush(self):
-		#this flush method is needed for python 3 compatibility.
-		#this handles the flush command by doing nothing.
-		#you might want to specify some extra behavior here.
-		pass	
+		# the lines printed without a new line are not lost
+		with self.lock:
+			for line in self.lines.values():
+				self.logger.info(line)
+			self.lines = {}
+
+sys.stdout = PrintToLog(log)
+# the pending line goes to the log before logging flushes its handlers at exit
+atexit.register(sys.stdout.flush)
+
+def rss_gb(since = 0):
+	# RSS memory used by the process in GB, minus *since* (in bytes)
+	return round((proc.memory_info().rss - since)/1024/1024/1024, 3)
 
-logfile = 'databases_extraction_{}_{}.log'.format(n_to_extract, date)
-sys.stdout = Logger(logfile)
+log.info('\nSTART RSS memory use (GB): {}'.format(rss_gb()))
 
 
 # START EXTRACTION:
 
 # 1. First extract interpro 
 
-print('\n1. TAKING CARE OF INTERPRO: {}\n'.format(interpro_file))
+log.info('\n1. TAKING CARE OF INTERPRO: {}\n'.format(interpro_file))
 
 start = time.time()
 day0  = date.today()
 
 interpro_db = interpro.interpro_db_diggested(mongo_host = MONGO_HOST, mongo_port = MONGO_PORT)
 
-print(' ... Extracting!\n')
-start_memory = psutil.Process(pid).memory_info().rss
+log.info(' ... Extracting!\n')
+start_memory = proc.memory_info().rss
 interpro_db.fill_from_file(interpro_file, print_step = 10000, chunk_size = chunk_size)
 
 numb_seconds = time.time() - start
 numb_days    = date.today() - day0
-print('\n ... Time to fill interpro_db: {} days {}'.format(numb_days.days, time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
-print(' ... Number of entries collected:', interpro_db.n_entries)
-print(' ... Total RSS memory use so far (GB):',  round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
-print(' ... Total RSS memory use for this step (GB):',  round((psutil.Process(pid).memory_info().rss - start_memory)/1024/1024/1024,3))
+log.info('\n ... Time to fill interpro_db: {} days {}'.format(numb_days.days, time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
+log.info(' ... Number of entries collected: {}'.format(interpro_db.n_entries))
+log.info(' ... Total RSS memory use so far (GB): {}'.format(rss_gb()))
+log.info(' ... Total RSS memory use for this step (GB): {}'.format(rss_gb(start_memory)))
 
-print(' ... Indexing!\n')
+log.info(' ... Indexing!\n')
 start = time.time()
 interpro_db.index_db()
 numb_seconds = time.time() - start
-print(' ... Time to index interpro_db: {}'.format(time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
-print(' ... Total RSS memory use so far (GB):',  round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
-print(' ... Total RSS memory use for this step (GB):',  round((psutil.Process(pid).memory_info().rss - start_memory)/1024/1024/1024,3))
+log.info(' ... Time to index interpro_db: {}'.format(time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
+log.info(' ... Total RSS memory use so far (GB): {}'.format(rss_gb()))
+log.info(' ... Total RSS memory use for this step (GB): {}'.format(rss_gb(start_memory)))
 
 # 2. Now extract target uniprots from uniprot (sprot and trembl) and add annotations coverages
 
-print('\n2. TAKING CARE OF UNIPROTS: {}\n'.format(uniprot_files))
+log.info('\n2. TAKING CARE OF UNIPROTS: {}\n'.format(uniprot_files))
 
 start = time.time()
 day0  = date.today()
@@ -116,34 +148,34 @@ uniprot_db.register(uniprot.family_extractor())
 uniprot_db.register(uniprot.name_extractor())
 uniprot_db.register(uniprot.evidence_extractor())
 
-start_memory = psutil.Process(pid).memory_info().rss
+start_memory = proc.memory_info().rss
 
 clear = True
 for uniprot_file in uniprot_files:
 
-    print(' ... Extracting {}\n'.format(uniprot_file))
+    log.info(' ... Extracting {}\n'.format(uniprot_file))
     uniprot_db.extract(uniprot_file, clear = clear, print_step = 10000, chunk_size = chunk_size, interpro_db = interpro_db)
 
     numb_seconds = time.time() - start
     numb_days    = date.today() - day0
-    print(' ... ... Time to fill uniprot_db with {}: {} days {}'.format(uniprot_file, numb_days.days, time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
-    print(' ... ... Number of entries collected:',uniprot_db.n_entries)
-    print(' ... ... Total RSS memory use so far (GB):',  round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
-    print(' ... ... Total RSS memory use for this step (GB):',  round((psutil.Process(pid).memory_info().rss - start_memory)/1024/1024/1024, 3))
+    log.info(' ... ... Time to fill uniprot_db with {}: {} days {}'.format(uniprot_file, numb_days.days, time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
+    log.info(' ... ... Number of entries collected: {}'.format(uniprot_db.n_entries))
+    log.info(' ... ... Total RSS memory use so far (GB): {}'.format(rss_gb()))
+    log.info(' ... ... Total RSS memory use for this step (GB): {}'.format(rss_gb(start_memory)))
     clear = False
 
-print(' ... Total RSS memory use so far (GB):', psutil.Process(pid).memory_info().rss/1024/1024/1024)
+log.info(' ... Total RSS memory use so far (GB): {}'.format(rss_gb()))
 
-print(' ... Indexing!\n')
+log.info(' ... Indexing!\n')
 start = time.time()
 uniprot_db.index_db()
 numb_seconds = time.time() - start
-print(' ... Time to index uniprot_db: {}'.format(time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
-print(' ... Total RSS memory use for this step (GB):',  round((psutil.Process(pid).memory_info().rss - start_memory)/1024/1024/1024,3))
+log.info(' ... Time to index uniprot_db: {}'.format(time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
+log.info(' ... Total RSS memory use for this step (GB): {}'.format(rss_gb(start_memory)))
 
 # 3. Now extract uniparcs from uniparc and add annotations coverages
 
-print('\n3. TAKING CARE OF UNIPARCS: {}\n'.format(uniparc_file))
+log.info('\n3. TAKING CARE OF UNIPARCS: {}\n'.format(uniparc_file))
 
 # start = time.time()
 # day0  = date.today()
@@ -154,27 +186,27 @@ uniparc_db.register(uniparc.seqlen_extractor())
 uniparc_db.register(uniparc.seq_extractor())
 uniparc_db.register(uniparc.taxid_extractor())
 
-print(' ... Extracting!\n')
-start_memory = psutil.Process(pid).memory_info().rss
+log.info(' ... Extracting!\n')
+start_memory = proc.memory_info().rss
 uniparc_db.extract(uniparc_file, print_step = 10000, chunk_size = chunk_size)
 
 numb_seconds = time.time() - start
 numb_days    = date.today() - day0
-print('\n ... Time to fill uniparc_db: {} days {}'.format(numb_days.days, time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
-print(' ... Number of entries collected:', uniparc_db.n_entries)
-print(' ... Total RSS memory use so far (GB):',  round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
-print(' ... Total RSS memory use for this step (GB):',  round((psutil.Process(pid).memory_info().rss - start_memory)/1024/1024/1024,3))
+log.info('\n ... Time to fill uniparc_db: {} days {}'.format(numb_days.days, time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
+log.info(' ... Number of entries collected: {}'.format(uniparc_db.n_entries))
+log.info(' ... Total RSS memory use so far (GB): {}'.format(rss_gb()))
+log.info(' ... Total RSS memory use for this step (GB): {}'.format(rss_gb(start_memory)))
 
-print(' ... Indexing!\n')
+log.info(' ... Indexing!\n')
 start = time.time()
 uniparc_db.index_db()
 numb_seconds = time.time() - start
-print(' ... Time to index uniparc_db: {}'.format(time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
-print(' ... Total RSS memory use for this step (GB):',  round((psutil.Process(pid).memory_info().rss - start_memory)/1024/1024/1024,3))
+log.info(' ... Time to index uniparc_db: {}'.format(time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
+log.info(' ... Total RSS memory use for this step (GB): {}'.format(rss_gb(start_memory)))
 
 # 4. Now extract the AlphaFold database information
 
-print('\n4. TAKING CARE OF {}\n'.format(alphafold_path))
+log.info('\n4. TAKING CARE OF {}\n'.format(alphafold_path))
 
 start = time.time()
 day0  = date.today()
@@ -182,24 +214,24 @@ day0  = date.today()
 alphafold_db = alphafold.alphafold_extractor(mongo_host = MONGO_HOST, mongo_port = MONGO_PORT)
 alphafold_db.register(alphafold.pLDDT_extractor())
 
-print('\n ... Extracting!\n')
-alphafold_db.extract(alphafold_path, max_size = n_to_extract, print_step = 10000, chunk_size = 10000)
+log.info('\n ... Extracting!\n')
+alphafold_db.extract(alphafold_path, max_size = n_to_extract, print_step = 10000, chunk_size = chunk_size)
 
 numb_seconds = time.time() - start
 numb_days    = date.today() - day0
-print('\n ... Time to fill Alphafold db: {} days {}'.format(numb_days.days, time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
-print(' ... Total RSS memory use so far (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+log.info('\n ... Time to fill Alphafold db: {} days {}'.format(numb_days.days, time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
+log.info(' ... Total RSS memory use so far (GB): {}'.format(rss_gb()))
 
-print(' ... Indexing!\n')
+log.info(' ... Indexing!\n')
 start = time.time()
 alphafold_db.index_db()
 numb_seconds = time.time() - start
-print(' ... Time to index alphafold_db: {}'.format(time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
-print(' ... Total RSS memory use for this step (GB):',  round((psutil.Process(pid).memory_info().rss - start_memory)/1024/1024/1024,3))
+log.info(' ... Time to index alphafold_db: {}'.format(time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
+log.info(' ... Total RSS memory use for this step (GB): {}'.format(rss_gb(start_memory)))
 
 # 5. Now extract uniref50, add darkness and select the darkness representatives
 
-print('\n5. TAKING CARE OF {}\n'.format(uniref50_file))
+log.info('\n5. TAKING CARE OF {}\n'.format(uniref50_file))
 
 start = time.time()
 day0  = date.today()
@@ -208,7 +240,7 @@ uniref50_db = uniref.uniref_extractor(mongo_host = MONGO_HOST, mongo_port = MONG
 uniref50_db.register(uniref.entries_extractor())
 uniref50_db.register(uniref.unirefs_extractor())
 
-print('\n ... Extracting!\n')
+log.info('\n ... Extracting!\n')
 
 clear = True
 uniref50_db.extract(uniref50_file, clear = clear, max_size = n_to_extract, print_step = 1000, savestep = 5000, chunk_size = 10000, uniprot_db = uniprot_db, uniparc_db = uniparc_db, alphafold_db = alphafold_db, update_unip = True)
@@ -216,19 +248,19 @@ uniref50_db.extract(uniref50_file, clear = clear, max_size = n_to_extract, print
 numb_seconds = time.time() - start
 numb_days    = date.today() - day0
 
-print('\n ... Time to fill uniref50 db: {} days {}'.format(numb_days.days, time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
-print(' ... Total RSS memory use so far (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+log.info('\n ... Time to fill uniref50 db: {} days {}'.format(numb_days.days, time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
+log.info(' ... Total RSS memory use so far (GB): {}'.format(rss_gb()))
 
-print(' ... Indexing!\n')
+log.info(' ... Indexing!\n')
 start = time.time()
 uniref50_db.index_db()
 numb_seconds = time.time() - start
-print(' ... Time to index uniref50_db: {}'.format(time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
-print(' ... Total RSS memory use for this step (GB):',  round((psutil.Process(pid).memory_info().rss - start_memory)/1024/1024/1024,3))
+log.info(' ... Time to index uniref50_db: {}'.format(time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
+log.info(' ... Total RSS memory use for this step (GB): {}'.format(rss_gb(start_memory)))
 
 ## 6. Now extract the updated names of the uniprots after Google naming
 
-print('\n6. TAKING CARE OF UPDATED UNIPROTS: {}\n'.format(uniprot_files_updated_names))
+log.info('\n6. TAKING CARE OF UPDATED UNIPROTS: {}\n'.format(uniprot_files_updated_names))
 
 start = time.time()
 day0  = date.today()
@@ -236,27 +268,27 @@ day0  = date.today()
 uniprot_db = uniprot.uniprot_extractor(mongo_host = MONGO_HOST, mongo_port = MONGO_PORT, name='UniProt_updated_names')
 uniprot_db.register(uniprot.name_extractor())
 
-start_memory = psutil.Process(pid).memory_info().rss
+start_memory = proc.memory_info().rss
 
 clear = False
 for uniprot_file in uniprot_files_updated_names:
 
-    print(' ... Extracting {}\n'.format(uniprot_file))
+    log.info(' ... Extracting {}\n'.format(uniprot_file))
     uniprot_db.extract(uniprot_file, clear = clear, print_step = 10000, chunk_size = chunk_size, process_coverages = False)
 
     numb_seconds = time.time() - start
     numb_days    = date.today() - day0
-    print(' ... ... Time to fill uniprot_db with {}: {} days {}'.format(uniprot_file, numb_days.days, time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
-    print(' ... ... Number of entries collected:',uniprot_db.n_entries)
-    print(' ... ... Total RSS memory use so far (GB):',  round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
-    print(' ... ... Total RSS memory use for this step (GB):',  round((psutil.Process(pid).memory_info().rss - start_memory)/1024/1024/1024, 3))
+    log.info(' ... ... Time to fill uniprot_db with {}: {} days {}'.format(uniprot_file, numb_days.days, time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
+    log.info(' ... ... Number of entries collected: {}'.format(uniprot_db.n_entries))
+    log.info(' ... ... Total RSS memory use so far (GB): {}'.format(rss_gb()))
+    log.info(' ... ... Total RSS memory use for this step (GB): {}'.format(rss_gb(start_memory)))
     clear = False
 
-print(' ... Total RSS memory use so far (GB):', psutil.Process(pid).memory_info().rss/1024/1024/1024)
+log.info(' ... Total RSS memory use so far (GB): {}'.format(rss_gb()))
 
-print(' ... Indexing!\n')
+log.info(' ... Indexing!\n')
 start = time.time()
 uniprot_db.index_db()
 numb_seconds = time.time() - start
-print(' ... Time to index uniprot_db: {}'.format(time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
-print(' ... Total RSS memory use for this step (GB):',  round((psutil.Process(pid).memory_info().rss - start_memory)/1024/1024/1024,3))
+log.info(' ... Time to index uniprot_db: {}'.format(time.strftime('%H hours %M min %S sec', time.gmtime(numb_seconds))))
+log.info(' ... Total RSS memory use for this step (GB): {}'.format(rss_gb(start_memory)))
@@ -3,21 +3,75 @@ import json
 import sys
 import time
 import gzip
+import zlib
 import tarfile
 import io
 import re
 import pickle
+import resource
+import threading
+import queue
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import pymongo
 
 try:
     import psutil
-except:
-    pass
+except ImportError:
+    psutil = None
 
 import numpy as np
 
+# orjson is much faster than json at decoding the confidence files and at 
+# encoding the entries stored in List mode (it directly returns bytes), but optional
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode()
+    _loads = json.loads
+
+# deflate (libdeflate bindings) inflates the small gzipped confidence files in one 
+# shot, much faster than the gzip module. It is optional, we fall back to zlib
+try:
+    import deflate
+    _gunzip = deflate.gzip_decompress
+except ImportError:
+    def _gunzip(data):
+        return zlib.decompress(data, 31) # 31: expect a gzip header and trailer
+
+# zstandard is optional, it is only needed when the entries stored in List mode
+# are compressed with compression = 'zstd' (with compression = 'block' it is
+# used if available). A single compressor is reused for 
+# all entries, avoiding to set up a new compression context per entry
+try:
+    import zstandard
+    _zstd_compressor = zstandard.ZstdCompressor(level = 3)
+    _zstd_decompressor = zstandard.ZstdDecompressor()
+except ImportError:
+    zstandard = None
+
 pid = os.getpid()
 
+_rss = {'proc': None, 'time': 0, 'gb': 0}
+
+def rss_gb():
+    # RSS memory used by the process, in GB. It is asked for in the main loops,
+    # so the process handle is reused and the value is sampled at most once per second.
+    # Without psutil, the peak RSS is reported, which is a single getrusage call
+    now = time.monotonic()
+    if now - _rss['time'] > 1:
+        if psutil is None:
+            _rss['gb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024/1024, 3)
+        else:
+            if _rss['proc'] is None:
+                _rss['proc'] = psutil.Process(pid)
+            _rss['gb'] = round(_rss['proc'].memory_info().rss/1024/1024/1024, 3)
+        _rss['time'] = now
+    return _rss['gb']
+
 class data_extractor_base:
     """Base class defining the interface for data extraction from uniprot 
     entries in text format. Children must implement :func:`id` and 
@@ -47,16 +101,23 @@ class alphafold_extractor:
     be registered with :class:`register`. Data extraction happens upon
     calling :func:`extract`.
     """
-    def __init__(self, mongo_host = None, mongo_port = None):
+    def __init__(self, mongo_host = None, mongo_port = None, compression = 'gzip', fast_insert = False):
+
+        if compression not in ['gzip', 'zstd', 'block']:
+            raise ValueError('compression must be either gzip, zstd or block')
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstandard is required for compression = zstd')
+        self.compression = compression
+        self.fast_insert = fast_insert
 
         if mongo_host is None or mongo_port is None:
-            self.data = list()
+            self.data = self._empty_data()
             self.entries = list()
             self.type = 'List'
         else:
             self.client = pymongo.MongoClient(mongo_host, mongo_port)
             self.db = self.client['Joana'] 
-            self.col = self.db['AlphaFold']
+            self.col = self._collection()
             self.type = 'Mongo'
 
         self.data_extractors = list()
@@ -69,10 +130,10 @@ class alphafold_extractor:
         """
         if self.type == 'Mongo':
             self.col.drop()
-            self.col = self.db['AlphaFold']
+            self.col = self._collection()
 
         elif self.type == 'List':
-            self.data = list()
+            self.data = self._empty_data()
             self.entries = list()
 
     def register(self, extractor):
@@ -84,7 +145,7 @@ class alphafold_extractor:
         """
         self.data_extractors.append(extractor)
 
-    def extract(self, alphafold_data, max_size = 'all', add_if_empty=True, clear = True, targets = 'all', chunk_size = 1000, print_step = 100000, saveto = None, savestep = 100000):
+    def extract(self, alphafold_data, max_size = 'all', add_if_empty=True, clear = True, targets = 'all', chunk_size = 1000, print_step = 100000, saveto = None, savestep = 100000, n_threads = None):
         """Process all entries in file(s) specified in *alphafold_data* with 
         registered data extractors.
         The data stored for a single entry is a dict with the return value of
@@ -102,9 +163,14 @@ class alphafold_extractor:
                              added to the per-entry data dicts. Thus, they might
                              be empty. If set to False, these dicts are ignored,
                              i.e. :func:`store` is not called for those.
+        :param n_threads:    Number of proteome tar files read concurrently. The
+                             data extractors run on the same threads, so only the
+                             extracted data of a tar is kept in memory.
+                             Default: number of CPUs, at most 4
 
         :type alphafold_data: :class:`str` / :class:`list` of :class:`str`
         :type add_if_empty: :class:`bool`
+        :type n_threads: :class:`int`
         """
 
         if clear:
@@ -115,25 +181,22 @@ class alphafold_extractor:
         self.curr_chunk_size = 0
         self.data_dict = list()
 
-        for uniprot_ac, entry in self._alphafold_entry_iterator(alphafold_data):
+        if self.type == 'Mongo':
+            self._start_writer()
+
+        for uniprot_ac, entry_data in self._alphafold_entry_iterator(alphafold_data, targets, n_threads = n_threads):
             self.item_count += 1
-            data = None
-
-            if targets == 'all' or uniprot_ac in targets:
-                entry_data = dict()
-                for extractor in self.data_extractors:
-                    data = extractor.extract(entry)
-                    if data is not None:
-                        entry_data[extractor.id()] = data
-                
+
+            # entry_data is None for the entries that are not targets
+            if entry_data is not None:
                 if len(entry_data) > 0 or add_if_empty:
                     self.store(uniprot_ac, entry_data)
 
                 if self.item_count % print_step == 0:
                     if targets == 'all':
-                        print('ALPHAFOLD:', self.item_count, self.n_entries, 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+                        print('ALPHAFOLD:', self.item_count, self.n_entries, 'RSS memory used (GB):', rss_gb())
                     else:
-                        print('ALPHAFOLD:', self.n_entries, 'out of {} targets'.format(len(targets)), 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+                        print('ALPHAFOLD:', self.n_entries, 'out of {} targets'.format(len(targets)), 'RSS memory used (GB):', rss_gb())
 
             if max_size != 'all' and self.item_count >= max_size:
                 break
@@ -146,10 +209,11 @@ class alphafold_extractor:
         if saveto is not None:
             self.save(saveto, self.item_count)
 
-        if self.type == 'Mongo' and data is not None:
-            self.store(uniprot_ac, data, end = True)
+        if self.type == 'Mongo':
+            self.store(uniprot_ac, None, end = True)
+            self._stop_writer()
 
-        print('ALPHAFOLD:', self.item_count, self.n_entries, 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+        print('ALPHAFOLD:', self.item_count, self.n_entries, 'RSS memory used (GB):', rss_gb())
 
     def store(self, ac, data, end = False):
 
@@ -168,7 +232,12 @@ class alphafold_extractor:
         """
 
         if self.type == 'List':
-            self.data.append(gzip.compress(json.dumps(data).encode()))
+            if self.compression == 'block':
+                payload = _dumps(data)
+                self.data += len(payload).to_bytes(4, 'little')
+                self.data += payload
+            else:
+                self.data.append(self._compress(_dumps(data)))
             self.entries.append(ac)
 
         elif self.type == 'Mongo':
@@ -179,7 +248,10 @@ class alphafold_extractor:
             if self.curr_chunk_size == self.chunk_size or end:
                 self._reorganize_data_dict()
                 if len(self.data_dict) > 0:
-                    self.col.insert_many(self.data_dict)
+                    # hand the batch over to the writer thread and keep parsing
+                    if self._writer_error is not None:
+                        raise self._writer_error
+                    self._queue.put(self.data_dict)
                     self.data_dict = list()
                     self.n_chunks += 1
                     self.curr_chunk_size = 0
@@ -189,14 +261,126 @@ class alphafold_extractor:
 
     ### METHODS FOR WHEN THE TYPE OF DB IS MONGO
 
+    def _start_writer(self):
+        # batches are inserted by a background thread, so that parsing overlaps
+        # with the writes to mongo. The queue is bounded to keep memory in check
+        self._queue = queue.Queue(maxsize = 4)
+        self._writer_error = None
+        self._writer = threading.Thread(target = self._drain, daemon = True)
+        self._writer.start()
+
+    def _stop_writer(self):
+        self._queue.put(None)
+        self._writer.join()
+        if self._writer_error is not None:
+            raise self._writer_error
+
+    def _drain(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                break
+            if self._writer_error is not None:
+                continue # keep consuming so that store() never blocks
+
+            try:
+                self.col.insert_many(batch, ordered = False, bypass_document_validation = not self.fast_insert)
+            except pymongo.errors.BulkWriteError as e:
+                write_errors = e.details['writeErrors']
+                print(' ... WARNING: {} documents failed to be inserted. First error: {}'.format(len(write_errors), write_errors[0]['errmsg']))
+            except Exception as e:
+                self._writer_error = e
+
+    def _collection(self):
+        col = self.db['AlphaFold']
+        if self.fast_insert:
+            col = col.with_options(write_concern = pymongo.WriteConcern(w = 0))
+        return col
+
     def query(self, ac):
         return self.col.find({ '_id': ac })
 
-    def index_db(self):
-        self.col.create_index('_id')
+    def index_db(self, fields = []):
+        """Creates secondary indexes for *fields*, all in one call. Call it once all 
+        the data is inserted. The _id field is always indexed by MongoDB, so by 
+        default there is nothing to do.
+
+        :param fields: Fields to index, e.g. 'data.LEN'. Default: none
+        :type fields: :class:`list` of :class:`str`
+        """
+        if len(fields) > 0:
+            self.col.create_indexes([pymongo.IndexModel([(field, pymongo.ASCENDING)]) for field in fields])
 
     ### METHODS FOR WHEN THE TYPE OF DB IS LIST
 
+    def decompress(self, blob):
+        """Decodes the data of an entry stored in List mode, i.e. an element of
+        *data*, with the compression the entries were stored with. Not available
+        with compression = 'block', use :func:`iter_data` instead.
+
+        :param blob: The compressed entry data
+        :type blob: :class:`bytes`
+        :returns: The entry data
+        :rtype: :class:`dict`
+        """
+        if getattr(self, 'compression', 'gzip') == 'zstd':
+            return _loads(_zstd_decompressor.decompress(blob))
+        return _loads(gzip.decompress(blob))
+
+    def iter_data(self):
+        """Yields the accession code and decoded data of the entries stored in 
+        List mode, whatever the compression they were stored with.
+
+        :returns: Pairs of accession code and entry data
+        :rtype: :class:`tuple` of :class:`str` and :class:`dict`
+        """
+        if getattr(self, 'compression', 'gzip') != 'block':
+            for ac, blob in zip(self.entries, self.data):
+                yield ac, self.decompress(blob)
+            return
+
+        # with compression = 'block', data holds all the json entries, each
+        # preceded by its length in 4 bytes
+        view = memoryview(self.data)
+        offset = 0
+        for ac in self.entries:
+            size = int.from_bytes(view[offset:offset+4], 'little')
+            offset += 4
+            yield ac, _loads(view[offset:offset+size])
+            offset += size
+
+    def _empty_data(self):
+        # entries are appended to a single buffer with compression = 'block'
+        if self.compression == 'block':
+            return bytearray()
+        return list()
+
+    def __getstate__(self):
+        # with compression = 'block', the buffer with all the entries is compressed
+        # at once when pickled (i.e., at checkpoints), instead of entry by entry
+        state = self.__dict__.copy()
+        if state.get('compression') == 'block' and isinstance(state.get('data'), bytearray):
+            if zstandard is not None:
+                state['data'] = ('zstd', _zstd_compressor.compress(bytes(self.data)))
+            else:
+                state['data'] = ('gzip', gzip.compress(bytes(self.data)))
+        return state
+
+    def __setstate__(self, state):
+        if state.get('compression') == 'block' and isinstance(state.get('data'), tuple):
+            codec, blob = state['data']
+            if codec == 'zstd':
+                state['data'] = bytearray(_zstd_decompressor.decompress(blob))
+            else:
+                state['data'] = bytearray(gzip.decompress(blob))
+        self.__dict__.update(state)
+
+    def _compress(self, payload):
+        if self.compression == 'zstd':
+            return _zstd_compressor.compress(payload)
+        return gzip.compress(payload)
+
+
     def save(self, saveto, curr_count, clean = True):
 
         self.checkpoint = '{}_{}.obj'.format(saveto, curr_count)
@@ -209,7 +393,7 @@ class alphafold_extractor:
 
         if clean:
             self.entries = list()
-            self.data = list()
+            self.data = self._empty_data()
 
     def save_index(self, saveto):
 
@@ -220,49 +404,77 @@ class alphafold_extractor:
         else:
             append_write = 'w' # make a new file if not
 
-        with open(saveto, append_write) as outf:
-            for uniprot_ac in self.entries:
-                outf.write('{}\t{}\n'.format(uniprot_ac, self.saved_index))
-
-        outf.close()
+        # the whole block is built at once and written in a single call
+        suffix = '\t{}\n'.format(self.saved_index)
+        with open(saveto, append_write, buffering = 1<<20) as outf:
+            outf.write(''.join([uniprot_ac + suffix for uniprot_ac in self.entries]))
 
     # HELPING METHODS
 
-    def _alphafold_entry_iterator(self, db_path):
+    def _alphafold_entry_iterator(self, db_path, targets = 'all', n_threads = None):
+        # proteome tars are independent from each other, so they are read by a pool
+        # of threads (tarfile and gzip release the GIL while reading/inflating), 
+        # which also run the data extractors. Only a few tars are in flight at any 
+        # time to keep memory bounded, and they are returned in order so fragments 
+        # of the same protein stay together
+        if n_threads is None:
+            n_threads = min(4, os.cpu_count())
 
         db_path = '{}/proteomes'.format(db_path)
-        for f in os.scandir(db_path): 
-            if f.path.endswith('.tar'):
-                tar = tarfile.open(f.path)
-                for fh in tar.getmembers():
-                    if '.cif' in fh.name :
-                        uniprot_ac = '-'.join(fh.name.split('-')[1:3])
-                        data = {'coords': fh.name}
-                    elif 'confidence' in fh.name and uniprot_ac in fh.name:
-                        conf_data = tar.extractfile(fh)
-                        conf_data = json.load(gzip.open(conf_data, 'rb'))
-                        data['confidence'] = conf_data
-                        
+        tar_paths = [f.path for f in os.scandir(db_path) if f.path.endswith('.tar')]
+
+        with ThreadPoolExecutor(max_workers = n_threads) as executor:
+            pending = collections.deque()
+            for tar_path in tar_paths:
+                pending.append(executor.submit(self._process_one_tar, tar_path, targets))
+                if len(pending) > n_threads:
+                    for uniprot_ac, data in pending.popleft().result():
                         yield uniprot_ac, data
+
+            while len(pending) > 0:
+                for uniprot_ac, data in pending.popleft().result():
+                    yield uniprot_ac, data
+
+    def _process_one_tar(self, tar_path, targets = 'all'):
+
+        # the tar is read as a stream, strictly in file order, and each member is
+        # read while positioned on it. The .cif and confidence members of a model
+        # are adjacent, so the last accession seen is all the state needed.
+        # The data extractors run right away, so the decoded per-residue confidences
+        # of a model are dropped as soon as it is extracted, and only the extracted 
+        # data (None if the model is not a target) is kept for the whole tar
+        entries = list()
+        uniprot_ac = None
+        with tarfile.open(tar_path, mode = 'r|') as tar:
+            for fh in tar:
+                if '.cif' in fh.name :
+                    uniprot_ac = '-'.join(fh.name.split('-')[1:3])
+                    data = {'coords': fh.name}
+                elif 'confidence' in fh.name and uniprot_ac is not None and uniprot_ac in fh.name:
+                    conf_data = _gunzip(tar.extractfile(fh).read())
+                    conf_data = _loads(conf_data)
+                    data['confidence'] = conf_data
+
+                    entry_data = None
+                    if targets == 'all' or uniprot_ac in targets:
+                        entry_data = dict()
+                        for extractor in self.data_extractors:
+                            extracted = extractor.extract(data)
+                            if extracted is not None:
+                                entry_data[extractor.id()] = extracted
+                    
+                    entries.append((uniprot_ac, entry_data))
+
+        return entries
     
     def _reorganize_data_dict(self):
-        
+        # groups the fragments of each protein under a single document, in one pass
         new_dict = {}
         for entry in self.data_dict:
-            _id  = entry['_id']
-            data = entry['data']
-            
-            new_id = _id.split('-')[0]
-            frg_id = _id.split('-')[1]
-            
-            if new_id not in new_dict:
-                new_dict[new_id] = {}
-            new_dict[new_id][frg_id] = data
+            new_id, frg_id = entry['_id'].split('-', 2)[:2]
+            new_dict.setdefault(new_id, {})[frg_id] = entry['data']
         
-        self.data_dict = list()
-        for ac in new_dict:
-            data = new_dict[ac]
-            self.data_dict.append({'_id': ac, 'data': data})
+        self.data_dict = [{'_id': ac, 'data': data} for ac, data in new_dict.items()]
 
 class pLDDT_extractor(data_extractor_base):
     """Implements interface defined in :class:`data_extractor_base` and extracts
@@ -283,11 +495,18 @@ class pLDDT_extractor(data_extractor_base):
         :returns: average pLDDT of the model, None if no entries found
         :rtype: :class:`float`
         """        
-        plddt = np.mean(entry['confidence']['confidenceScore'])
+        scores = entry['confidence']['confidenceScore']
+        # cast to a python float, so the BSON/JSON encoders do not need to deal with numpy scalars
+        plddt = float(np.fromiter(scores, dtype = np.float64, count = len(scores)).mean())
+
+        # count all categories in a single pass, using the ascii code of each
+        # category letter as its bin
+        categories = entry['confidence']['confidenceCategory']
+        categ_counts = np.bincount(np.frombuffer(''.join(categories).encode('ascii'), dtype = np.uint8), minlength = 128)
         confcat_freq = {}
-        for categ in {'M', 'D', 'H', 'L'}:
-            confcat_freq[categ] = entry['confidence']['confidenceCategory'].count(categ)*100/len(entry['confidence']['confidenceCategory'])
+        for categ in 'MDHL':
+            confcat_freq[categ] = int(categ_counts[ord(categ)])*100/len(categories)
         
-        return {'avg_pLDDT': plddt, 'CategoriesFreq': confcat_freq, 'Lenght': len(entry['confidence']['confidenceScore'])}
+        return {'avg_pLDDT': plddt, 'CategoriesFreq': confcat_freq, 'Lenght': len(scores)}
 
     
\ No newline at end of file
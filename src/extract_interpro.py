@@ -6,27 +6,179 @@ import gzip
 import io
 import re
 import pickle
+import resource
+import itertools
+import bisect
+import operator
+import subprocess
+import threading
+import multiprocessing
+import collections
+import queue
 import pymongo
 
 try:
     import psutil
-except:
-    pass
+except ImportError:
+    psutil = None
 
 import numpy as np
 
+# rapidgzip (formerly pragzip) decompresses a single gzip stream in parallel
+# from within python. It is optional, we fall back to unpigz/gzip otherwise
+try:
+	import rapidgzip
+except ImportError:
+	try:
+		import pragzip as rapidgzip
+	except ImportError:
+		rapidgzip = None
+
+# orjson encodes the entries stored in List mode much faster than json, and 
+# directly returns bytes. It is optional, we fall back to json otherwise
+try:
+	import orjson
+	_dumps = orjson.dumps
+	_loads = orjson.loads
+except ImportError:
+	def _dumps(obj):
+		return json.dumps(obj).encode()
+	_loads = json.loads
+
+# zstandard is optional, it is only needed when the entries stored in List mode
+# are compressed with compression = 'zstd' (with compression = 'block' it is
+# used if available). A single compressor is reused for 
+# all entries, avoiding to set up a new compression context per entry
+try:
+	import zstandard
+	_zstd_compressor = zstandard.ZstdCompressor(level = 3)
+	_zstd_decompressor = zstandard.ZstdDecompressor()
+except ImportError:
+	zstandard = None
+
 pid = os.getpid()
 
+_rss = {'proc': None, 'time': 0, 'gb': 0}
+
+def rss_gb():
+	# RSS memory used by the process, in GB. It is asked for in the main loops,
+	# so the process handle is reused and the value is sampled at most once per second.
+	# Without psutil, the peak RSS is reported, which is a single getrusage call
+	now = time.monotonic()
+	if now - _rss['time'] > 1:
+		if psutil is None:
+			_rss['gb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024/1024, 3)
+		else:
+			if _rss['proc'] is None:
+				_rss['proc'] = psutil.Process(pid)
+			_rss['gb'] = round(_rss['proc'].memory_info().rss/1024/1024/1024, 3)
+		_rss['time'] = now
+	return _rss['gb']
+
+def _gz_rows(path):
+	"""Yields the rows of a gzipped text file. Decompression is done in parallel
+	with ``rapidgzip`` if installed, otherwise it is piped through ``unpigz``,
+	which inflates on a separate process (and threads), and falls back to 
+	:mod:`gzip` if pigz is not installed either.
+
+	:param path: Path to the .gz file
+	:type path: :class:`str`
+	"""
+	if rapidgzip is not None:
+		# any gzip file works, but pigz/bgzf-compressed inputs give maximal
+		# parallelism. Leave half of the cores for the parsing thread
+		with rapidgzip.open(path, parallelization = max(1, os.cpu_count()//2)) as fh:
+			with io.TextIOWrapper(fh, encoding='utf-8') as decoder:
+				for row in decoder:
+					yield row
+		return
+
+	try:
+		proc = subprocess.Popen(['unpigz', '-c', path], stdout = subprocess.PIPE, bufsize = 1<<22)
+	except FileNotFoundError:
+		with gzip.open(path, 'rb') as fh:
+			with io.TextIOWrapper(fh, encoding='utf-8') as decoder:
+				for row in decoder:
+					yield row
+		return
+
+	with proc:
+		with io.TextIOWrapper(proc.stdout, encoding='utf-8') as decoder:
+			for row in decoder:
+				yield row
+	if proc.returncode != 0:
+		raise RuntimeError('unpigz failed to decompress {} (exit code {})'.format(path, proc.returncode))
+
+def _compile_ignore(ignore):
+	# single regex to check if an annotation contains any of the terms in *ignore*
+	if len(ignore) == 0:
+		return re.compile('(?!)') # never matches
+	return re.compile('|'.join(re.escape(ext) for ext in ignore))
+
+def _group_rows(rows):
+	# protein2ipr is sorted by uniprot accession, so all the rows of an entry
+	# are contiguous. Group them with itertools.groupby, which does the
+	# bookkeeping in C, and return them at once per accession
+	rows = (row.split('\t', 6) for row in rows)
+	for uniprot_ac, items in itertools.groupby(rows, key = operator.itemgetter(0)):
+		annotations = list()
+		intervals = list()
+		for item in items:
+			# the same few thousand annotations repeat over and over, so intern them
+			annotations.append(sys.intern(item[2]))
+			intervals.append([int(item[4]), int(item[5])])
+
+		yield uniprot_ac, annotations, intervals
+
+def _batch_rows(rows, batch_size):
+	# cuts the rows into batches of about *batch_size* rows, without splitting 
+	# the rows of an entry across batches
+	batch = list()
+	for row in rows:
+		if len(batch) >= batch_size and row.split('\t', 1)[0] != batch[-1].split('\t', 1)[0]:
+			yield batch
+			batch = list()
+		batch.append(row)
+
+	if len(batch) > 0:
+		yield batch
+
+def _merge_entries(entries, targets, simplify, exclude_duf, ignore_re):
+	# merges and formats the annotations of the target entries. Others get None
+	for uniprot_ac, annotations, intervals in entries:
+		id_data = None
+		if uniprot_ac in targets or targets == 'all':
+			id_data = interpro_db_diggested._merge_intervals(annotations, intervals, ignore_re = ignore_re)
+			id_data = interpro_db_diggested._format_annotations(id_data, simplify, exclude_duf, ignore_re = ignore_re)
+		yield uniprot_ac, id_data
+
+# worker processes get the arguments of _merge_entries once, when they start
+
+_worker_args = None
+
+def _init_worker(*args):
+	global _worker_args
+	_worker_args = args
+
+def _merge_batch(rows):
+	return list(_merge_entries(_group_rows(rows), *_worker_args))
+
 # Interpro class
 
 class interpro_db_diggested:
 	"""Sets up a dictionary database, that can be filled from a text file (the protein2ipr.dat.gz )
 	available from Interpro, or a prefilled json file.
 	"""
-	def __init__(self, mongo_host = None, mongo_port = None):
+	def __init__(self, mongo_host = None, mongo_port = None, compression = 'gzip'):
+
+		if compression not in ['gzip', 'zstd', 'block']:
+			raise ValueError('compression must be either gzip, zstd or block')
+		if compression == 'zstd' and zstandard is None:
+			raise ImportError('zstandard is required for compression = zstd')
+		self.compression = compression
 
 		if mongo_host is None or mongo_port is None:
-			self.data = list()
+			self.data = self._empty_data()
 			self.entries = list()
 			self.type = 'List'
 		else:
@@ -47,7 +199,7 @@ class interpro_db_diggested:
 			self.col = self.db['Interpro']
 
 		elif self.type == 'List':
-			self.data = list()
+			self.data = self._empty_data()
 			self.entries = list()
 	
 	def save_to_pickle(self, out_file):
@@ -60,7 +212,7 @@ class interpro_db_diggested:
 		pickle.dump(self, open(out_file, 'wb'))
 
 		
-	def fill_from_file(self, file_path, max_size = 'all', print_step = 100000, targets = 'all', saveto = None, clear = True, savestep = 100000, chunk_size = 1000, simplify = False, exclude_duf = False, ignore = ['Putative','DUF','Uncharacter','Putative', 'nknown']):
+	def fill_from_file(self, file_path, max_size = 'all', print_step = 100000, targets = 'all', saveto = None, clear = True, savestep = 100000, chunk_size = 1000, simplify = False, exclude_duf = False, ignore = ['Putative','DUF','Uncharacter','Putative', 'nknown'], n_processes = 1):
 		"""Clears content from interpro collection in db and refills it with the
 		content from *file_path*.
 
@@ -74,10 +226,14 @@ class interpro_db_diggested:
 							for testing, when we want to include a maximum of 
 							entries in the database. Default: None					   
 		:param print_step:  Step count to print progress. Default: 100000 
+		:param n_processes: Number of worker processes merging the intervals of
+							the entries. The file is still read, and the data 
+							stored, by the calling process. Default: 1
 
 		:type file_path: :class:`str`
 		:type max_size: :class:`str` 
 		:type print_step: :class:`str` 
+		:type n_processes: :class:`int` 
 		"""
 
 		# clean the mongo collection
@@ -85,55 +241,51 @@ class interpro_db_diggested:
 			self.clear()
 
 		added_domains = 0
-		previous_entry = None
 		self.chunk_size = chunk_size
 		self.n_chunks = 0
 		self.curr_chunk_size = 0
 		self.data_dict = list()
 
+		if self.type == 'Mongo':
+			self._start_writer()
+
+		ignore_re = _compile_ignore(ignore)
+
+		if n_processes > 1:
+			entries = self._parallel_entry_iterator(file_path, n_processes, targets, simplify, exclude_duf, ignore_re)
+		else:
+			entries = _merge_entries(self._entry_iterator(file_path), targets, simplify, exclude_duf, ignore_re)
+
 		n_targets = len(targets)
-		for item in self._file_iterator(file_path):
-			item = item.split('\t')
-			uniprot_ac = item[0]
-			if uniprot_ac != previous_entry:
-				if previous_entry is not None:
-					self.item_count += 1
-					if previous_entry in targets or targets == 'all':
-
-						id_data = self._format_annotations(id_data, simplify, exclude_duf, ignore = ignore)
-						self.store(previous_entry, id_data)
-						added_domains += len(id_data)
-											
-						if self.item_count%print_step == 0:
-							if targets == 'all':
-								print('INTERPRO:', self.item_count, self.n_entries, 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
-							else:
-								print('INTERPRO:', self.item_count, self.n_entries, 'out of {} targets'.format(n_targets), 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
-							
-					if max_size != 'all' and self.item_count >= max_size :
-						break
-					elif targets != 'all' and self.n_entries == n_targets:
-						break
-
-					if self.type != 'Mongo' and saveto is not None and self.item_count % savestep == 0:
-						self.save(saveto, self.item_count)
-
-				id_data = {'Annotation': [item[2]], 'Interval': [[int(item[4]), int(item[5])]]}
-			else:
-				curr_interval = [int(item[4]), int(item[5])]
-				curr_annotation = item[2]
-				
-				id_data = self._update_intervals(curr_interval, curr_annotation, id_data, ignore = ignore)
-				
-			previous_entry = uniprot_ac
+		for uniprot_ac, id_data in entries:
+			self.item_count += 1
+			if uniprot_ac in targets or targets == 'all':
+
+				self.store(uniprot_ac, id_data)
+				added_domains += len(id_data)
+									
+				if self.item_count%print_step == 0:
+					if targets == 'all':
+						print('INTERPRO:', self.item_count, self.n_entries, 'RSS memory used (GB):', rss_gb())
+					else:
+						print('INTERPRO:', self.item_count, self.n_entries, 'out of {} targets'.format(n_targets), 'RSS memory used (GB):', rss_gb())
+					
+			if max_size != 'all' and self.item_count >= max_size :
+				break
+			elif targets != 'all' and self.n_entries == n_targets:
+				break
+
+			if self.type != 'Mongo' and saveto is not None and self.item_count % savestep == 0:
+				self.save(saveto, self.item_count)
 
 		if self.type != 'Mongo' and saveto is not None:
 			self.save(saveto, self.item_count)
 
 		if self.type == 'Mongo':
-			self.store(uniprot_ac, id_data, end = True)
+			self.store(None, None, end = True)
+			self._stop_writer()
 
-		print('INTERPRO:', self.item_count, self.n_entries, 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+		print('INTERPRO:', self.item_count, self.n_entries, 'RSS memory used (GB):', rss_gb())
 
 	def store(self, ac, data, end = False):
 
@@ -152,35 +304,156 @@ class interpro_db_diggested:
 		"""
 
 		if self.type == 'List':
-			self.data.append(gzip.compress(json.dumps(data).encode()))
+			if self.compression == 'block':
+				payload = _dumps(data)
+				self.data += len(payload).to_bytes(4, 'little')
+				self.data += payload
+			else:
+				self.data.append(self._compress(_dumps(data)))
 			self.entries.append(ac)
 
 		elif self.type == 'Mongo':
-			self.data_dict.append({'_id': ac, 'data': data})
-			self.curr_chunk_size += 1
+			if not end:
+				self.data_dict.append({'_id': ac, 'data': data})
+				self.curr_chunk_size += 1
 			
-			if self.curr_chunk_size == self.chunk_size or end:
-				try:
-					self.col.insert_many(self.data_dict)
-					self.data_dict = list()
-					self.n_chunks += 1
-					self.curr_chunk_size = 0
-				except:
-					pass
+			if (self.curr_chunk_size == self.chunk_size or end) and len(self.data_dict) > 0:
+				# hand the batch over to the writer thread and keep parsing
+				if self._writer_error is not None:
+					raise self._writer_error
+				self._queue.put(self.data_dict)
+				self.data_dict = list()
+				self.n_chunks += 1
+				self.curr_chunk_size = 0
 		
-		self.last_ac = ac
-		self.n_entries += 1
+		if not end:
+			self.last_ac = ac
+			self.n_entries += 1
 
 
 	### METHODS FOR WHEN THE TYPE OF DB IS MONGO
 
+	def _start_writer(self):
+		# batches are inserted by a background thread, so that parsing overlaps
+		# with the writes to mongo. The queue is bounded to keep memory in check
+		self._queue = queue.Queue(maxsize = 4)
+		self._writer_error = None
+		self._writer = threading.Thread(target = self._drain, daemon = True)
+		self._writer.start()
+
+	def _stop_writer(self):
+		self._queue.put(None)
+		self._writer.join()
+		if self._writer_error is not None:
+			raise self._writer_error
+
+	def _drain(self):
+		while True:
+			batch = self._queue.get()
+			if batch is None:
+				break
+			if self._writer_error is not None:
+				continue # keep consuming so that store() never blocks
+
+			try:
+				self.col.insert_many(batch, ordered = False, bypass_document_validation = True)
+			except pymongo.errors.BulkWriteError as e:
+				write_errors = e.details['writeErrors']
+				print(' ... WARNING: {} documents failed to be inserted. First error: {}'.format(len(write_errors), write_errors[0]['errmsg']))
+			except Exception as e:
+				self._writer_error = e
+
 	def query(self, ac):
 		return self.col.find({ '_id': ac })
 
-	def index_db(self):
-		self.col.create_index('_id')
+	def query_many(self, acs):
+		"""Finds the entries of all the accession codes in *acs* in a single query.
+
+		:param acs: Accession codes
+		:type acs: :class:`list` of :class:`str`
+		"""
+		return self.col.find({ '_id': { '$in': list(acs) } })
+
+	def index_db(self, fields = []):
+		"""Creates secondary indexes for *fields*, all in one call. Call it once all 
+		the data is inserted. The _id field is always indexed by MongoDB, so by 
+		default there is nothing to do.
+
+		:param fields: Fields to index, e.g. 'data.LEN'. Default: none
+		:type fields: :class:`list` of :class:`str`
+		"""
+		if len(fields) > 0:
+			self.col.create_indexes([pymongo.IndexModel([(field, pymongo.ASCENDING)]) for field in fields])
         
 	### METHODS FOR WHEN THE TYPE OF DB IS LIST
+
+	def decompress(self, blob):
+		"""Decodes the data of an entry stored in List mode, i.e. an element of
+		*data*, with the compression the entries were stored with. Not available
+		with compression = 'block', use :func:`iter_data` instead.
+
+		:param blob: The compressed entry data
+		:type blob: :class:`bytes`
+		:returns: The entry data
+		:rtype: :class:`dict`
+		"""
+		if getattr(self, 'compression', 'gzip') == 'zstd':
+			return _loads(_zstd_decompressor.decompress(blob))
+		return _loads(gzip.decompress(blob))
+
+	def iter_data(self):
+		"""Yields the accession code and decoded data of the entries stored in 
+		List mode, whatever the compression they were stored with.
+
+		:returns: Pairs of accession code and entry data
+		:rtype: :class:`tuple` of :class:`str` and :class:`dict`
+		"""
+		if getattr(self, 'compression', 'gzip') != 'block':
+			for ac, blob in zip(self.entries, self.data):
+				yield ac, self.decompress(blob)
+			return
+
+		# with compression = 'block', data holds all the json entries, each
+		# preceded by its length in 4 bytes
+		view = memoryview(self.data)
+		offset = 0
+		for ac in self.entries:
+			size = int.from_bytes(view[offset:offset+4], 'little')
+			offset += 4
+			yield ac, _loads(view[offset:offset+size])
+			offset += size
+
+	def _empty_data(self):
+		# entries are appended to a single buffer with compression = 'block'
+		if self.compression == 'block':
+			return bytearray()
+		return list()
+
+	def __getstate__(self):
+		# with compression = 'block', the buffer with all the entries is compressed
+		# at once when pickled (i.e., at checkpoints), instead of entry by entry
+		state = self.__dict__.copy()
+		if state.get('compression') == 'block' and isinstance(state.get('data'), bytearray):
+			if zstandard is not None:
+				state['data'] = ('zstd', _zstd_compressor.compress(bytes(self.data)))
+			else:
+				state['data'] = ('gzip', gzip.compress(bytes(self.data)))
+		return state
+
+	def __setstate__(self, state):
+		if state.get('compression') == 'block' and isinstance(state.get('data'), tuple):
+			codec, blob = state['data']
+			if codec == 'zstd':
+				state['data'] = bytearray(_zstd_decompressor.decompress(blob))
+			else:
+				state['data'] = bytearray(gzip.decompress(blob))
+		self.__dict__.update(state)
+
+	def _compress(self, payload):
+		if self.compression == 'zstd':
+			return _zstd_compressor.compress(payload)
+		return gzip.compress(payload)
+
 	def save(self, saveto, curr_count, clean = True):
 
 		self.checkpoint = '{}_{}.obj'.format(saveto, curr_count)
@@ -193,7 +466,7 @@ class interpro_db_diggested:
 
 		if clean:
 			self.entries = list()
-			self.data = list()
+			self.data = self._empty_data()
 
 	def save_index(self, saveto):
 
@@ -204,58 +477,99 @@ class interpro_db_diggested:
 		else:
 			append_write = 'w' # make a new file if not
 
-		with open(saveto, append_write) as outf:
-			for uniprot_ac in self.entries:
-				outf.write('{}\t{}\n'.format(uniprot_ac, self.saved_index))
-
-		outf.close()
+		# the whole block is built at once and written in a single call
+		suffix = '\t{}\n'.format(self.saved_index)
+		with open(saveto, append_write, buffering = 1<<20) as outf:
+			outf.write(''.join([uniprot_ac + suffix for uniprot_ac in self.entries]))
 		
+	def _entry_iterator(self, f):
+		return _group_rows(self._file_iterator(f))
+
+	def _parallel_entry_iterator(self, f, n_processes, targets, simplify, exclude_duf, ignore_re, batch_size = 100000):
+		# batches of rows, never splitting an entry, are parsed and merged by a pool
+		# of processes. Only a few batches are in flight at any time to keep memory
+		# bounded, and they are returned in the order of the file
+		with multiprocessing.Pool(n_processes, initializer = _init_worker, initargs = (targets, simplify, exclude_duf, ignore_re)) as pool:
+			pending = collections.deque()
+			for batch in _batch_rows(self._file_iterator(f), batch_size):
+				pending.append(pool.apply_async(_merge_batch, (batch,)))
+				if len(pending) > 2*n_processes:
+					for entry in pending.popleft().get():
+						yield entry
+
+			while len(pending) > 0:
+				for entry in pending.popleft().get():
+					yield entry
+
 	def _file_iterator(self, f):
 		if f.endswith('.gz'):
-			with gzip.open(f, 'rb') as fh:
-				with io.TextIOWrapper(fh, encoding='utf-8') as decoder:
-					for row in decoder:
-						yield row.rstrip() 
+			for row in _gz_rows(f):
+				yield row.rstrip()
 		else:
 			with open(f) as fh:
 				for row in fh:
 					yield row.rstrip()
    
-	def _update_intervals(self, interval, annotation, data, ignore):
-
-		new_data = data.copy()
-		overlaps_with = []
-		
-		for i in range(len(data['Interval'])):
-			curr_interval = data['Interval'][i]
-			overlap_range = curr_interval+interval
-			if (curr_interval[1]-curr_interval[0])+(interval[1]-interval[0]) > max(overlap_range)-min(overlap_range):
-				# they overlap
-				overlaps_with.append(i)
-				
-				if curr_interval[1]-curr_interval[0] > interval[1]-interval[0]:
-					if not any(ext in data['Annotation'][i] for ext in ignore):
-					   annotation = data['Annotation'][i]
-					
-				interval = [min(overlap_range), max(overlap_range)]
-			
-		new_data = {key: [data[key][i] for i in range(len(data[key])) if i not in overlaps_with] for key in data}
-		new_data['Annotation'].append(annotation)
-		new_data['Interval'].append(interval)
-
-		return new_data
+	@staticmethod
+	def _merge_intervals(annotations, intervals, ignore_re):
+		# merges all the overlapping intervals of an entry, at once. The merged 
+		# intervals are kept sorted by start, so the ones a new interval overlaps
+		# are found by bisection instead of scanning all of them. As merged intervals
+		# never overlap each other, only the last one starting before the new interval
+		# can reach into it. Each interval keeps the order it was added in, which 
+		# decides the annotation kept when merging and the order of the output
+		# annotations_extractor._merge_intervals in extract_uniparc.py is a copy of this merge,
+		# as each module stands on its own: keep both in sync
+		starts = list()
+		merged = list() # [start, end, order, annotation], sorted by start
+		for order, (annotation, interval) in enumerate(zip(annotations, intervals)):
+			start, end = interval
+			overlaps_with = []
+
+			if end > start:
+				first = bisect.bisect_left(starts, start)
+				last = bisect.bisect_left(starts, end)
+
+				i = first - 1
+				while i >= 0 and merged[i][1] <= merged[i][0]:
+					i -= 1 # empty intervals never overlap anything
+				if i >= 0 and merged[i][1] > start:
+					overlaps_with.append(i)
+
+				overlaps_with += [i for i in range(first, last) if merged[i][1] > merged[i][0]]
+
+			for i in sorted(overlaps_with, key = lambda i: merged[i][2]):
+				curr_start, curr_end, _, curr_annotation = merged[i]
+				if curr_end-curr_start > end-start:
+					if not ignore_re.search(curr_annotation):
+						annotation = curr_annotation
+
+				start, end = min(curr_start, start), max(curr_end, end)
+
+			for i in reversed(overlaps_with):
+				del starts[i]
+				del merged[i]
+
+			i = bisect.bisect_right(starts, start)
+			starts.insert(i, start)
+			merged.insert(i, [start, end, order, annotation])
+
+		merged.sort(key = operator.itemgetter(2))
+		return {'Annotation': [m[3] for m in merged], 'Interval': [[m[0], m[1]] for m in merged]}
 	
-	def _format_annotations(self, data, simplify, exclude_duf, ignore):
+	@staticmethod
+	def _format_annotations(data, simplify, exclude_duf, ignore_re):
 
 		if len(data['Annotation']) > 0:
-			annotations = []
-			for annotation in set(data['Annotation']):
-				if not exclude_duf or not any(ext in annotation for ext in ignore):
-					if simplify:
-						curr_lst = tuple(tuple(data['Interval'][i]) for i in range(len(data['Annotation'])) if data['Annotation'][i] == annotation)
-					else:
-						curr_lst = tuple([annotation] + [tuple(data['Interval'][i]) for i in range(len(data['Annotation'])) if data['Annotation'][i] == annotation])
-					annotations.append(curr_lst)
-			return tuple(annotations)
+			# intervals grouped per annotation in a single pass, in order of appearance
+			groups = {}
+			for annotation, interval in zip(data['Annotation'], data['Interval']):
+				if annotation in groups:
+					groups[annotation].append(tuple(interval))
+				elif not exclude_duf or not ignore_re.search(annotation):
+					groups[annotation] = [tuple(interval)]
+			if simplify:
+				return tuple(tuple(curr_intervals) for curr_intervals in groups.values())
+			return tuple(tuple([annotation] + curr_intervals) for annotation, curr_intervals in groups.items())
 		else:
 			return None
\ No newline at end of file
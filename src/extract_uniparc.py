@@ -3,20 +3,315 @@ import json
 import sys
 import time
 import gzip
-import io
 import re
 import pickle
+import resource
+import mmap
+import array
+import multiprocessing
+import collections
+import bisect
+import operator
+import functools
+import subprocess
 import pymongo
+import bson
+from bson.raw_bson import RawBSONDocument
 
 try:
     import psutil
-except:
-    pass
+except ImportError:
+    psutil = None
 
 import numpy as np
 
+# rapidgzip (formerly pragzip) decompresses a single gzip stream in parallel
+# from within python, and isal inflates much faster than zlib. Both are optional, 
+# we fall back to unpigz/gzip otherwise
+try:
+	import rapidgzip
+except ImportError:
+	try:
+		import pragzip as rapidgzip
+	except ImportError:
+		rapidgzip = None
+
+try:
+	from isal import igzip as _gzip
+except ImportError:
+	_gzip = gzip
+
+# zstandard is optional, it is only needed when the entries stored in List mode
+# are compressed with compression = 'zstd'. A dictionary is then trained on the
+# first entries stored, so that the keys and values that repeat across entries
+# are not stored over and over
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+# numba is optional, it compiles the interval merge that computes the full coverage
+# of each entry. The same kernel runs as plain python otherwise
+try:
+	from numba import njit
+except ImportError:
+	njit = None
+
+# entries stored in List mode are encoded with a single, compact json encoder.
+# orjson (used by the InterPro and AlphaFold extractors) is not an option here, 
+# as it writes the NaN coverages as null and cannot decode them back
+_json_encoder = json.JSONEncoder(separators = (',', ':'))
+
+def _dumps(obj):
+	return _json_encoder.encode(obj).encode()
+
+_ZSTD_DICT_SAMPLES = 1000
+_ZSTD_DICT_SIZE = 100000
+
 pid = os.getpid()
 
+_rss = {'proc': None, 'time': 0, 'gb': 0}
+
+def rss_gb():
+	# RSS memory used by the process, in GB. It is asked for in the main loops,
+	# so the process handle is reused and the value is sampled at most once per second.
+	# Without psutil, the peak RSS is reported, which is a single getrusage call
+	now = time.monotonic()
+	if now - _rss['time'] > 1:
+		if psutil is None:
+			_rss['gb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024/1024, 3)
+		else:
+			if _rss['proc'] is None:
+				_rss['proc'] = psutil.Process(pid)
+			_rss['gb'] = round(_rss['proc'].memory_info().rss/1024/1024/1024, 3)
+		_rss['time'] = now
+	return _rss['gb']
+
+def _gz_blocks(path, block_size = 1<<22):
+	"""Yields the decompressed content of a gzipped file, in blocks of bytes. 
+	Decompression is done in parallel with ``rapidgzip`` if installed, otherwise
+	it is piped through ``unpigz``, which inflates on a separate process (and 
+	threads), and falls back to ``isal`` or :mod:`gzip` if pigz is not installed either.
+
+	:param path: Path to the .gz file
+	:type path: :class:`str`
+	"""
+	if rapidgzip is not None:
+		# the multi-GB uniparc xml is by far the largest input, use all the cores
+		with rapidgzip.open(path, parallelization = os.cpu_count()) as fh:
+			yield from iter(lambda: fh.read(block_size), b'')
+		return
+
+	try:
+		proc = subprocess.Popen(['unpigz', '-c', path], stdout = subprocess.PIPE, bufsize = 1<<22)
+	except FileNotFoundError:
+		with _gzip.open(path, 'rb') as fh:
+			yield from iter(lambda: fh.read(block_size), b'')
+		return
+
+	with proc:
+		yield from iter(lambda: proc.stdout.read(block_size), b'')
+	if proc.returncode != 0:
+		raise RuntimeError('unpigz failed to decompress {} (exit code {})'.format(path, proc.returncode))
+
+_ignore_res = {}
+
+def _compile_ignore(ignore):
+	# single regex to check if an annotation contains any of the terms in *ignore*.
+	# It is asked for every entry, so it is compiled once per list of terms
+	key = tuple(ignore)
+	if key not in _ignore_res:
+		if len(ignore) == 0:
+			_ignore_res[key] = re.compile('(?!)') # never matches
+		else:
+			_ignore_res[key] = re.compile('|'.join(re.escape(ext) for ext in ignore))
+	return _ignore_res[key]
+
+class _entry_rows(list):
+	"""The rows of an entry. :func:`_entry_text` keeps them joined in a single
+	string, so the extractors can look for the rows they need with C-level 
+	string searches instead of testing all rows one by one.
+	"""
+	text = None
+	sequence_pos = None
+	canonical = None
+
+	def __getstate__(self):
+		# only the rows are sent to the worker processes, what is cached is not
+		return {}
+
+# maps all the ascii whitespace but the newline to spaces, so that the rows ending
+# with whitespace, which have to be stripped one by one, are found with a single search
+_SPACES = bytes.maketrans(b'\t\x0b\x0c\r\x1c\x1d\x1e\x1f', b'        ')
+
+def _split_entry(chunk):
+	# the rows of an entry, from its raw bytes. The chunk is decoded at once, and 
+	# unless some rows end with whitespace (or it is not plain ascii), it already 
+	# is the text of the entry
+	spaced = chunk.translate(_SPACES)
+	if chunk.isascii() and b'\r' not in chunk and b' \n' not in spaced and not spaced.endswith(b' '):
+		text = chunk.decode('ascii')
+		entry = _entry_rows(text.split('\n'))
+		entry.text = text
+	else:
+		# newlines are translated as when reading in text mode. A trailing \r is 
+		# the first half of the \r\n the entry was cut at
+		if chunk.endswith(b'\r'):
+			chunk = chunk[:-1]
+		text = chunk.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+		entry = _entry_rows([row.rstrip() for row in text.split('\n')])
+	return entry
+
+def _entry_text(entry):
+	# the rows of *entry* joined by newlines, computed once per entry
+	text = getattr(entry, 'text', None)
+	if text is None:
+		text = '\n'.join(entry)
+		if isinstance(entry, _entry_rows):
+			entry.text = text
+	return text
+
+def _covered_length(intervals):
+	"""Returns the number of residues covered by the union of the (start, end)
+	intervals in a 2 column array, sorted by their start and merged in a single pass.
+
+	:param intervals: The intervals, one per row
+	:type intervals: :class:`numpy.ndarray`
+	"""
+	intervals = intervals[np.argsort(intervals[:, 0], kind = 'mergesort')]
+	curr_start = intervals[0, 0]
+	curr_end = intervals[0, 1]
+	total = 0
+	for i in range(1, len(intervals)):
+		start = intervals[i, 0]
+		end = intervals[i, 1]
+		if start <= curr_end:
+			curr_end = max(curr_end, end)
+		else:
+			total += curr_end - curr_start
+			curr_start = start
+			curr_end = end
+	total += curr_end - curr_start
+	return total
+
+if njit is not None:
+	_covered_length = njit(_covered_length)
+
+# the values the extractors need, read straight from the rows of the entry
+
+_ACCESSION_RE = re.compile(r'<accession>([^<]*)')
+_TAXID_RE = re.compile(r'NCBI_taxonomy_id"\s+value="([^"]*)"')
+_SEQUENCE_RE = re.compile(r'<sequence[^"]*"([^"]*)"[^>]*>([^<]*)')
+_IPR_RE = re.compile(r'<ipr name="([^"]*)"')
+_LCN_RE = re.compile(r'<lcn start="(-?\d+)"\s+end="(-?\d+)"')
+
+def _sequence_pos(entry):
+	# the position of the sequence row in the text of *entry*, -1 if there is none. 
+	# It is looked for once per entry, and shared by the accession code, sequence 
+	# length and sequence extractors
+	pos = getattr(entry, 'sequence_pos', None)
+	if pos is None:
+		pos = _entry_text(entry).find('<sequence')
+		if isinstance(entry, _entry_rows):
+			entry.sequence_pos = pos
+	return pos
+
+def _canonical_sequence(entry):
+	# the sequence length and sequence of *entry*, read and checked once per entry
+	canonical = getattr(entry, 'canonical', None)
+	if canonical is None:
+		n_AA = None
+		canonical_seq = None
+		text = _entry_text(entry)
+		pos = _sequence_pos(entry)
+		if pos != -1:
+			if text.find('<sequence', pos+1) != -1:
+				raise RuntimeError('Expect one canonical seq per entry')
+			length, canonical_seq = _SEQUENCE_RE.match(text, pos).groups()
+			n_AA = int(length)
+		if canonical_seq and n_AA != len(canonical_seq):
+			raise RuntimeError('Invalid seq length observed')
+		canonical = (n_AA, canonical_seq)
+		if isinstance(entry, _entry_rows):
+			entry.canonical = canonical
+	return canonical
+
+def _process_entry(entry, ac_extractor, extractors, coverages_processor, targets, add_if_empty, min_len):
+	# runs the extractors on an entry. Returns its accession code and the data 
+	# to store, None if it is not a target or should not be stored. *extractors*
+	# are (id, extract) pairs, see uniparc_extractor._extract_functions
+	uniparc_ac = ac_extractor.extract(entry)
+	if uniparc_ac is None or (targets != 'all' and uniparc_ac not in targets):
+		return uniparc_ac, None
+
+	entry_data = dict()
+	for extractor_id, extract in extractors:
+		data = extract(entry)
+		if data is not None:
+			entry_data[extractor_id] = data
+
+	if len(entry_data) > 0 or add_if_empty:
+		if 'LEN' not in entry_data or entry_data['LEN'] >= min_len:
+			return uniparc_ac, coverages_processor.extract(entry_data)
+	return uniparc_ac, None
+
+# worker processes get the extractors and the arguments of _process_entry once,
+# when they start
+
+_worker_args = None
+
+def _init_worker(*args):
+	global _worker_args
+	_worker_args = args
+
+def _process_batch(entries):
+	return [_process_entry(entry, *_worker_args) for entry in entries]
+
+class _packed_bytes:
+	"""List-like sequence of :class:`bytes`, that are stored back to back in a 
+	single buffer along with their offsets, instead of as a python object each.
+	It supports what List mode needs: append, len, indexing and iteration.
+	"""
+	def __init__(self):
+		self.buffer = bytearray()
+		self.offsets = array.array('q', [0])
+
+	def append(self, item):
+		self.buffer += item
+		self.offsets.append(len(self.buffer))
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self[j] for j in range(*i.indices(len(self)))]
+		if i < 0:
+			i += len(self)
+		if i < 0 or i >= len(self):
+			raise IndexError('index out of range')
+		return self._decode(bytes(self.buffer[self.offsets[i]:self.offsets[i+1]]))
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+
+	def iter_bytes(self):
+		# iterates over the items as stored, without decoding them
+		for i in range(len(self)):
+			yield bytes(self.buffer[self.offsets[i]:self.offsets[i+1]])
+
+	def _decode(self, item):
+		return item
+
+class _packed_strings(_packed_bytes):
+	"""Same as :class:`_packed_bytes`, for strings (e.g. accession codes)."""
+	def append(self, item):
+		_packed_bytes.append(self, item.encode())
+
+	def _decode(self, item):
+		return item.decode()
+
 # UniParc class and extractors
 
 class data_extractor_base:
@@ -47,15 +342,16 @@ class uniparc_extractor:
 	be registered with :class:`register`. Data extraction happens upon
 	calling :func:`extract`.
 	"""
-	def __init__(self, mongo_host = None, mongo_port = None):
+	def __init__(self, mongo_host = None, mongo_port = None, compression = 'gzip', fast_insert = False):
+		self.fast_insert = fast_insert
 		if mongo_host is None or mongo_port is None:
-			self.data = list()
-			self.entries = list()
+			self.data = _packed_bytes()
+			self.entries = _packed_strings()
 			self.type = 'List'
 		else:
 			self.client = pymongo.MongoClient(mongo_host, mongo_port)
 			self.db = self.client['Joana'] 
-			self.col = self.db['UniParc']
+			self.col = self._collection()
 			self.type = 'Mongo'
 
 		self.data_extractors = list()
@@ -64,6 +360,14 @@ class uniparc_extractor:
 		self.n_entries = 0
 		self.item_count = 0
 
+		if compression not in ['gzip', 'zstd']:
+			raise ValueError('compression must be either gzip or zstd')
+		if compression == 'zstd' and zstandard is None:
+			raise ImportError('zstandard is required for compression = zstd')
+		self.compression = compression
+		self.zstd_dict = None
+		self.pending = list()
+
 	def clear(self):
 		"""
 		Clean the database. It becomes an empty set of lists.
@@ -71,12 +375,12 @@ class uniparc_extractor:
 		if self.type == 'Mongo':
 			print(' ... ... Cleaning DB')
 			self.col.drop()
-			self.col = self.db['UniParc']
+			self.col = self._collection()
 			print(' ... ... Done!')
 
 		elif self.type == 'List':
-			self.data = list()
-			self.entries = list()
+			self.data = _packed_bytes()
+			self.entries = _packed_strings()
 			
 	def register(self, extractor):
 		"""Register new data extractor. In the data extraction phase, all 
@@ -87,7 +391,7 @@ class uniparc_extractor:
 		"""
 		self.data_extractors.append(extractor)
 
-	def extract(self, uniparc_data, add_if_empty=True, clear = True, max_size = 'all', targets = 'all', chunk_size = 1000, print_step = 10000, saveto = None, savestep = 100000, min_len = 0, simplify_anno = False, exclude_duf = False, ignore = ['Putative','DUF','Uncharacter','Putative', 'nknown']):
+	def extract(self, uniparc_data, add_if_empty=True, clear = True, max_size = 'all', targets = 'all', chunk_size = 10000, print_step = 10000, saveto = None, savestep = 100000, min_len = 0, simplify_anno = False, exclude_duf = False, ignore = ['Putative','DUF','Uncharacter','Putative', 'nknown'], n_processes = 1, checkpoints = 'pickle'):
 		"""Process all entries in file(s) specified in *uniparc_data* with 
 		registered data extractors. 
 
@@ -109,12 +413,27 @@ class uniparc_extractor:
 							 i.e. :func:`store` is not called for those.
 		:param max_size:	 Maximum number of elements to extract. Default: all
 		:param targets:	  Target accession codes to extract. Default: all
+		:param n_processes:  Number of worker processes running the data 
+							 extractors. The file is still read, and the data
+							 stored, by the calling process. Default: 1
+		:param checkpoints:  How checkpoints are written in List mode when 
+							 *saveto* is given. 'pickle' saves the entries since
+							 the previous checkpoint to a new <saveto>_<count>.obj
+							 file. 'append' appends them to a single <saveto>.bin 
+							 file, with their offsets in <saveto>.offsets, to be 
+							 read back with :func:`load`. Default: 'pickle'
 
 		:type uniparc_data: :class:`str` / :class:`list` of :class:`str`
 		:type add_if_empty: :class:`bool`
 		:type max_size: :class:`int`
 		:type targets: :class:`str` / :class:`list` of :class:`str`
+		:type n_processes: :class:`int`
+		:type checkpoints: :class:`str`
 		"""
+		if checkpoints not in ['pickle', 'append']:
+			raise ValueError('checkpoints must be either pickle or append')
+		self.checkpoints = checkpoints
+
 		if clear:
 			self.clear()
 
@@ -123,34 +442,35 @@ class uniparc_extractor:
 		self.curr_chunk_size = 0
 		self.data_dict = list()
 
-		for entry in self._uniparc_entry_iterator(uniparc_data):
+		if targets != 'all':
+			targets = set(targets)
+
+		extractors = self._extract_functions(simplify_anno, exclude_duf, ignore)
+		process_args = (self.ac_extractor, extractors, self.coverages_processor, targets, add_if_empty, min_len)
+		if n_processes > 1:
+			entries = self._parallel_entry_iterator(uniparc_data, n_processes, process_args)
+		else:
+			entries = (_process_entry(entry, *process_args) for entry in self._uniparc_entry_iterator(uniparc_data))
+
+		# progress is printed each time *print_step* more entries are stored
+		next_print = (self.n_entries // print_step + 1) * print_step
+		uniparc_ac = None
+		for uniparc_ac, entry_data in entries:
 			self.item_count += 1
 
-			uniparc_ac = self.ac_extractor.extract(entry)
 			if uniparc_ac is not None:
 				# raise RuntimeError('Observed None uniparc AC')
 			
 				if targets == 'all' or uniparc_ac in targets:
-					entry_data = dict()
-					for extractor in self.data_extractors:
-						if extractor.id() == 'ANNO':
-							data = extractor.extract(entry, simplify = simplify_anno, exclude_duf = exclude_duf, ignore = ignore)
-						else:
-							data = extractor.extract(entry)
+					if entry_data is not None:
+						self.store(uniparc_ac, entry_data)
 
-						if data is not None:
-							entry_data[extractor.id()] = data
-
-					if len(entry_data) > 0 or add_if_empty:
-						if 'LEN' not in entry_data or entry_data['LEN'] >= min_len:
-							entry_data = self.coverages_processor.extract(entry_data)
-							self.store(uniparc_ac, entry_data)
-
-					if self.n_entries % print_step == 0 and self.n_entries > 0:
+					if self.n_entries >= next_print:
+						next_print += print_step
 						if targets == 'all':
-							print('UNIPARC:', self.item_count, self.n_entries, 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+							print('UNIPARC:', self.item_count, self.n_entries, 'RSS memory used (GB):', rss_gb())
 						else:
-							print('UNIPARC:', self.item_count, self.n_entries, 'out of {} targets'.format(len(targets)), 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+							print('UNIPARC:', self.item_count, self.n_entries, 'out of {} targets'.format(len(targets)), 'RSS memory used (GB):', rss_gb())
 					
 				if max_size != 'all' and self.item_count >= max_size:
 					break
@@ -162,11 +482,13 @@ class uniparc_extractor:
 
 		if saveto is not None:
 			self.save(saveto, self.item_count)
+		elif self.type == 'List' and len(self.pending) > 0:
+			self._train_zstd_dict()
 
 		if self.type == 'Mongo':
-			self.store(uniparc_ac, data, end = True)
+			self.store(uniparc_ac, None, end = True)
 
-		print('UNIPARC:', self.item_count, self.n_entries, 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+		print('UNIPARC:', self.item_count, self.n_entries, 'RSS memory used (GB):', rss_gb())
 
 	def store(self, ac, data, end = False):
 
@@ -185,49 +507,198 @@ class uniparc_extractor:
 		"""
 
 		if self.type == 'List':
-			self.data.append(gzip.compress(json.dumps(data).encode()))
-			self.entries.append(ac)
+			payload = _dumps(data)
+			if self.compression == 'zstd' and self.zstd_dict is None:
+				# kept aside until there are enough entries to train the dictionary
+				self.pending.append((ac, payload))
+				if len(self.pending) == _ZSTD_DICT_SAMPLES:
+					self._train_zstd_dict()
+			else:
+				self.data.append(self._compress(payload))
+				self.entries.append(ac)
 
 		elif self.type == 'Mongo':
 			if not end:
-				self.data_dict.append({'_id': ac, 'data': data})
+				# each document is encoded as it comes, and inserted as is. The batch
+				# then holds compact BSON instead of the entries' python objects
+				self.data_dict.append(RawBSONDocument(bson.encode({'_id': ac, 'data': data})))
 				self.curr_chunk_size += 1
 			
-			if self.curr_chunk_size == self.chunk_size or end:
+			if (self.curr_chunk_size == self.chunk_size or end) and len(self.data_dict) > 0:
+				# unordered, so that a failing document does not stop the rest of the batch
 				try:
-					self.col.insert_many(self.data_dict)
-					self.data_dict = list()
-					self.n_chunks += 1
-					self.curr_chunk_size = 0
-				except:
-					pass
+					self.col.insert_many(self.data_dict, ordered = False, bypass_document_validation = not self.fast_insert)
+				except pymongo.errors.BulkWriteError as e:
+					write_errors = e.details['writeErrors']
+					print(' ... WARNING: {} documents failed to be inserted. First error: {}'.format(len(write_errors), write_errors[0]['errmsg']))
+				self.data_dict = list()
+				self.n_chunks += 1
+				self.curr_chunk_size = 0
 		
-		self.last_ac = ac
-		self.n_entries += 1
+		if not end:
+			self.last_ac = ac
+			self.n_entries += 1
 
 	### METHODS FOR WHEN THE TYPE OF DB IS MONGO
 
+	def _collection(self):
+		# with fast_insert, inserts are not acknowledged by the server (w = 0), and
+		# failed writes go unnoticed. pymongo refuses bypass_document_validation with
+		# w = 0, so document validation is only bypassed without fast_insert
+		col = self.db['UniParc']
+		if self.fast_insert:
+			col = col.with_options(write_concern = pymongo.WriteConcern(w = 0))
+		return col
+
 	def query(self, ac):
 		return self.col.find({ '_id': ac })
 
-	def index_db(self):
-		self.col.create_index('_id')
+	def index_db(self, fields = []):
+		"""Creates secondary indexes for *fields*, all in one call. Call it once all 
+		the data is inserted. The _id field is always indexed by MongoDB, so by 
+		default there is nothing to do.
+
+		:param fields: Fields to index, e.g. 'data.LEN'. Default: none
+		:type fields: :class:`list` of :class:`str`
+		"""
+		if len(fields) > 0:
+			self.col.create_indexes([pymongo.IndexModel([(field, pymongo.ASCENDING)]) for field in fields])
         
 	### METHODS FOR WHEN THE TYPE OF DB IS LIST
 
+	def decompress(self, blob):
+		"""Decodes the data of an entry stored in List mode, i.e. an element of
+		*data*, with the compression the entries were stored with.
+
+		:param blob: The compressed entry data
+		:type blob: :class:`bytes`
+		:returns: The entry data
+		:rtype: :class:`dict`
+		"""
+		if getattr(self, 'compression', 'gzip') == 'gzip':
+			return json.loads(gzip.decompress(blob))
+		return json.loads(self._zstd_context(zstandard.ZstdDecompressor).decompress(blob))
+
+	def _compress(self, payload):
+		if self.compression == 'zstd':
+			return self._zstd_context(zstandard.ZstdCompressor).compress(payload)
+		return gzip.compress(payload)
+
+	def _train_zstd_dict(self):
+		# trains the dictionary on the entries kept aside, and stores them
+		samples = [payload for _, payload in self.pending]
+		try:
+			self.zstd_dict = zstandard.train_dictionary(_ZSTD_DICT_SIZE, samples).as_bytes()
+		except zstandard.ZstdError:
+			self.zstd_dict = b'' # too little data to train on, go without dictionary
+
+		for ac, payload in self.pending:
+			self.data.append(self._compress(payload))
+			self.entries.append(ac)
+		self.pending = list()
+
+	def _zstd_context(self, kind):
+		# (de)compression contexts are reused for all entries, and set up lazily
+		# as they can not be pickled
+		contexts = self.__dict__.setdefault('_zstd_contexts', {})
+		if kind not in contexts:
+			kwargs = {}
+			if len(self.zstd_dict) > 0:
+				kwargs['dict_data'] = zstandard.ZstdCompressionDict(self.zstd_dict)
+			if kind is zstandard.ZstdCompressor:
+				kwargs['level'] = 3
+			contexts[kind] = kind(**kwargs)
+		return contexts[kind]
+
+	def __getstate__(self):
+		# checkpoints only keep the data and the settings: the mongo handles can 
+		# not be pickled, and the (de)compression contexts are set up again when 
+		# needed. data and entries are packed buffers, so they are pickled as a 
+		# few large byte strings rather than one object per entry
+		state = self.__dict__.copy()
+		for key in ['_zstd_contexts', 'client', 'db', 'col', 'data_dict']:
+			state.pop(key, None)
+		return state
+
 	def save(self, saveto, curr_count, clean = True):
 
-		self.checkpoint = '{}_{}.obj'.format(saveto, curr_count)
+		if len(self.pending) > 0:
+			self._train_zstd_dict()
+
 		self.saved_index = curr_count
+		if self.type == 'List' and getattr(self, 'checkpoints', 'pickle') == 'append':
+			self._append_checkpoint(saveto)
+			return
+
+		self.checkpoint = '{}_{}.obj'.format(saveto, curr_count)
 
 		print('\n ... Saving to: {}'.format(self.checkpoint))
-		pickle.dump(self, open('{}'.format(self.checkpoint), 'wb'))
+		with open(self.checkpoint, 'wb') as outf:
+			pickle.dump(self, outf, protocol = pickle.HIGHEST_PROTOCOL)
 
 		self.save_index(saveto)
 
 		if clean:
-			self.entries = list()
-			self.data = list()
+			self.entries = _packed_strings()
+			self.data = _packed_bytes()
+
+	def _append_checkpoint(self, saveto):
+		# the data stored since the previous checkpoint is appended to <saveto>.bin,
+		# and the offsets of the entries in it to <saveto>.offsets, so that no
+		# checkpoint rewrites what was already saved. <saveto>.obj only keeps the 
+		# settings (e.g. the zstd dictionary) and is overwritten each time
+		self.checkpoint = '{}.bin'.format(saveto)
+
+		print('\n ... Appending to: {}'.format(self.checkpoint))
+		with open(self.checkpoint, 'ab') as outf:
+			base = outf.tell()
+			outf.write(self.data.buffer)
+			outf.flush()
+			os.fsync(outf.fileno())
+
+		offsets = np.frombuffer(self.data.offsets, dtype = np.int64) + base
+		with open('{}.offsets'.format(saveto), 'ab') as outf:
+			# the leading 0 is only written once, when the file is created
+			if outf.tell() > 0:
+				offsets = offsets[1:]
+			outf.write(offsets.tobytes())
+			outf.flush()
+			os.fsync(outf.fileno())
+
+		self.save_index(saveto)
+
+		# the data is on disk now, so it is always cleaned
+		self.entries = _packed_strings()
+		self.data = _packed_bytes()
+		with open('{}.obj'.format(saveto), 'wb') as outf:
+			pickle.dump(self, outf, protocol = pickle.HIGHEST_PROTOCOL)
+
+	@staticmethod
+	def load(saveto):
+		"""Loads the entries saved with checkpoints = 'append'. The data file is
+		memory mapped, so an entry is only read from disk when accessed, and the 
+		loaded object is read only.
+
+		:param saveto: The *saveto* the entries were extracted with
+		:type saveto: :class:`str`
+		:returns: The extractor, with all the saved entries
+		:rtype: :class:`uniparc_extractor`
+		"""
+		with open('{}.obj'.format(saveto), 'rb') as inf:
+			db = pickle.load(inf)
+
+		db.data = _packed_bytes()
+		if os.path.getsize('{}.bin'.format(saveto)) > 0:
+			with open('{}.bin'.format(saveto), 'rb') as inf:
+				db.data.buffer = mmap.mmap(inf.fileno(), 0, access = mmap.ACCESS_READ)
+			db.data.offsets = np.memmap('{}.offsets'.format(saveto), dtype = np.int64, mode = 'r')
+
+		db.entries = _packed_strings()
+		with open('{}.INDEX'.format(saveto)) as inf:
+			for row in inf:
+				db.entries.append(row.split('\t', 1)[0])
+
+		return db
 
 	def save_index(self, saveto):
 
@@ -238,11 +709,11 @@ class uniparc_extractor:
 		else:
 			append_write = 'w' # make a new file if not
 
-		with open(saveto, append_write) as outf:
-			for uniparc_ac in self.entries:
-				outf.write('{}\t{}\n'.format(uniparc_ac, self.saved_index))
-
-		outf.close()
+		# the whole block is built at once, from the packed accession codes as bytes,
+		# and written in a single call
+		suffix = '\t{}\n'.format(self.saved_index).encode()
+		with open(saveto, append_write + 'b') as outf:
+			outf.write(b''.join([uniparc_ac + suffix for uniparc_ac in self.entries.iter_bytes()]))
 	
 
 	def _uniparc_entry_iterator(self, uniparc_ac, max_entry_size=1048576):
@@ -264,34 +735,92 @@ class uniparc_extractor:
 		else:
 			raise RuntimeError('uniparc_data must either be string or list of \
 								strings referring to existing files')
-		# iterate and return entry by entry
-		current_entry = list()
-		current_entry_size = 0
-		for row in self._uniparc_file_iterator(files):
-			# if current_entry_size > max_entry_size:
-			# 	raise RuntimeError('Observed Entry too large to process')
-			if row.startswith('</entry>'):
-				if len(current_entry) > 0:
-					yield current_entry
-				current_entry = list()
-				current_entry_size = 0
+		# iterate and return entry by entry. Entries are kept as lists of rows on
+		# purpose: the extractors only do substring checks on a few rows, which is
+		# cheaper than building an element tree per entry with an xml parser. 
+		# They are cut at the rows starting with '</entry>' straight from the raw
+		# bytes read, and each is then decoded in one go. *data* always starts 
+		# with the newline that ends the previous row
+		data = b'\n'
+		for block in self._uniparc_file_iterator(files):
+			if len(block) == 0:
+				# end of the input, the last row is ended if it was not
+				if not data.endswith(b'\n'):
+					data += b'\n'
 			else:
-				current_entry.append(row)
-				current_entry_size += 1
-		if len(current_entry) > 0:
-			yield current_entry
-
-	def _uniparc_file_iterator(self, files):
+				data += block
+			pos = 1
+			while True:
+				end = data.find(b'\n</entry>', pos - 1)
+				if end == -1:
+					break
+				next_pos = data.find(b'\n', end + 9) + 1
+				if next_pos == 0:
+					break
+				if end >= pos:
+					yield _split_entry(data[pos:end])
+				pos = next_pos
+			data = data[pos - 1:]
+
+		if len(data) > 1:
+			yield _split_entry(data[1:-1])
+
+	def _extract_functions(self, simplify_anno, exclude_duf, ignore):
+		# the id and extract function of each registered extractor, resolved once
+		# per extraction instead of once per entry. The annotations extractor gets
+		# its options bound
+		extractors = []
+		for extractor in self.data_extractors:
+			extract = extractor.extract
+			if extractor.id() == 'ANNO':
+				extract = functools.partial(extract, simplify = simplify_anno, exclude_duf = exclude_duf, ignore = ignore)
+			extractors.append((extractor.id(), extract))
+		return tuple(extractors)
+
+	def _parallel_entry_iterator(self, uniparc_data, n_processes, process_args, batch_size = 1000):
+		# batches of entries are processed by a pool of processes. Only a few batches
+		# are in flight at any time to keep memory bounded, and they are returned
+		# in the order of the file
+		with multiprocessing.Pool(n_processes, initializer = _init_worker, initargs = process_args) as pool:
+			pending = collections.deque()
+			batch = list()
+			for entry in self._uniparc_entry_iterator(uniparc_data):
+				batch.append(entry)
+				if len(batch) == batch_size:
+					pending.append(pool.apply_async(_process_batch, (batch,)))
+					batch = list()
+				if len(pending) > 2*n_processes:
+					for result in pending.popleft().get():
+						yield result
+
+			if len(batch) > 0:
+				pending.append(pool.apply_async(_process_batch, (batch,)))
+			while len(pending) > 0:
+				for result in pending.popleft().get():
+					yield result
+
+	def _uniparc_file_iterator(self, files, block_size = 1<<22):
+		# the content of all the files, in blocks of bytes. A file not ending with
+		# a newline is given one, so rows do not run across files, and an empty 
+		# block marks the end
+		last = b'\n'
 		for f in files:
 			if f.endswith('.gz'):
-				with gzip.open(f, 'rb') as fh:
-					with io.TextIOWrapper(fh, encoding='utf-8') as decoder:
-						for row in decoder:
-							yield row.rstrip() 
+				blocks = _gz_blocks(f, block_size = block_size)
 			else:
-				with open(f) as fh:
-					for row in fh:
-						yield row.rstrip()
+				blocks = self._file_blocks(f, block_size)
+			for block in blocks:
+				last = block
+				yield block
+			if not last.endswith(b'\n'):
+				last = b'\n'
+				yield last
+		yield b''
+
+	@staticmethod
+	def _file_blocks(f, block_size):
+		with open(f, 'rb') as fh:
+			yield from iter(lambda: fh.read(block_size), b'')
 
 class ac_extractor(data_extractor_base):
 	"""Implements interface defined in :class:`data_extractor_base` and extracts
@@ -311,14 +840,15 @@ class ac_extractor(data_extractor_base):
 		:returns: The uniprot accession code, None if not found
 		:rtype: :class:`str`
 		"""
-		for line in entry:
-			if '<accession>U' in line:
-				ac = line.split('>')[1].split('<')[0]
-			elif 'type="UniProtKB' in line:
-				return None
-			elif '<sequence' in line:
-				return ac
-		return None
+		# only the rows before the sequence matter
+		text = _entry_text(entry)
+		seq_pos = _sequence_pos(entry)
+		if seq_pos == -1 or text.find('type="UniProtKB', 0, seq_pos) != -1:
+			return None
+		ac_pos = text.rfind('<accession>U', 0, seq_pos)
+		if ac_pos == -1:
+			return None
+		return _ACCESSION_RE.match(text, ac_pos).group(1)
 
 class taxid_extractor(data_extractor_base):
 	"""Implements interface defined in :class:`data_extractor_base` and extracts
@@ -341,9 +871,11 @@ class taxid_extractor(data_extractor_base):
 		species_name = ''
 		taxid = None
 		taxa = []
-		for line in entry:
-			if 'NCBI_taxonomy_id' in line:
-				taxid = int(line.split('=')[-1].split('"')[1])
+		# the last taxonomy id of the entry is kept
+		text = _entry_text(entry)
+		pos = text.rfind('NCBI_taxonomy_id')
+		if pos != -1:
+			taxid = int(_TAXID_RE.match(text, pos).group(1))
 
 		# print([taxid, species_name, taxa])
 		return [taxid, species_name, taxa]
@@ -366,20 +898,7 @@ class seqlen_extractor(data_extractor_base):
 		:returns: The canonical sequence len, None if not found
 		:rtype: :class:`str`
 		"""
-		n_AA = None
-		in_sq = False
-		sq_found = False
-		canonical_seq = None
-		for line in entry:
-			if '<sequence' in line:
-				if sq_found:
-					raise RuntimeError('Expect one canonical seq per entry')
-				canonical_seq = line.split('>')[1].split('<')[0]
-				in_sq = True
-				sq_found = True
-				n_AA = int(line.split('"')[1].strip('"'))
-		if canonical_seq and n_AA != len(canonical_seq):
-			raise RuntimeError('Invalid seq length observed')
+		n_AA, canonical_seq = _canonical_sequence(entry)
 		return n_AA
 
 class seq_extractor(data_extractor_base):
@@ -400,26 +919,20 @@ class seq_extractor(data_extractor_base):
 		:returns: The canonical sequence len, None if not found
 		:rtype: :class:`str`
 		"""
-		n_AA = None
-		in_sq = False
-		sq_found = False
-		canonical_seq = None
-		for line in entry:
-			if '<sequence' in line:
-				if sq_found:
-					raise RuntimeError('Expect one canonical seq per entry')
-				canonical_seq = line.split('>')[1].split('<')[0]
-				in_sq = True
-				sq_found = True
-				n_AA = int(line.split('"')[1].strip('"'))
-		if canonical_seq and n_AA != len(canonical_seq):
-			raise RuntimeError('Invalid seq length observed')
+		n_AA, canonical_seq = _canonical_sequence(entry)
 		return canonical_seq
 	
 class annotations_extractor(data_extractor_base):
 	"""Implements interface defined in :class:`data_extractor_base` and extracts
 	the annotations of an entry.
 	"""
+	def __init__(self):
+		# buffers reused for every entry, instead of allocating new lists each time
+		self._annotation_buf = list()
+		self._interval_buf = list()
+		self._starts_buf = list()
+		self._merged_buf = list()
+
 	def id(self):
 		"""Implements functionality defined in :func:`data_extractor_base.id`
 		
@@ -438,63 +951,106 @@ class annotations_extractor(data_extractor_base):
 		:returns: The sequence signatures/matches with corresponding intervals, None if not found. Overlapping annotations are merged if diggest set to True.
 		:rtype: :class:`str`
 		"""
-		annotations = {'Annotation': [], 'Interval': []}
+		# the annotations are collected first and merged at once at the end
+		annotation_list = self._annotation_buf
+		interval_list = self._interval_buf
+		annotation_list.clear()
+		interval_list.clear()
+		# only the rows from the first signature match to the last one are looked at
+		text = _entry_text(entry)
+		first = text.find('<signatureSequenceMatch database="')
+		if first == -1:
+			rows = []
+		else:
+			last = text.rfind('</signatureSequenceMatch>')
+			start = text.rfind('\n', 0, first) + 1
+			end = text.find('\n', last) if last > first else -1
+			rows = text[start:end if end != -1 else len(text)].split('\n')
+
 		found_annotation = False
-		for line in entry:
+		for line in rows:
 			if '<signatureSequenceMatch database="' in line:
 				found_annotation = True
 			elif '</signatureSequenceMatch>' in line:
 				found_annotation = False
 			elif found_annotation:
 				if '<ipr name=' in line:
-					annotation = line.split('=')[1].split('"')[1].strip('"')
+					annotation = _IPR_RE.search(line).group(1)
 				elif '<lcn start=' in line:
-					interval = [int(line.split('=')[1].split()[0].strip('"')), int(line.split('=')[2].split('/')[0].strip('"'))]
-					
-					if diggest:
-						annotations = self._update_intervals(interval, annotation, annotations, ignore = ignore)
-					else:
-						annotations['Annotation'].append(annotation)
-						annotations['Interval'].append(interval)
+					start, end = _LCN_RE.search(line).groups()
+					interval = [int(start), int(end)]
+					annotation_list.append(annotation)
+					interval_list.append(interval)
 		
-		return self._format_annotations(annotations, simplify, exclude_duf, ignore = ignore)
-		
-	def _update_intervals(self, interval, annotation, data, ignore):
+		ignore_re = _compile_ignore(ignore)
+		if diggest:
+			annotations = self._merge_intervals(annotation_list, interval_list, ignore_re = ignore_re)
+		else:
+			annotations = {'Annotation': annotation_list, 'Interval': interval_list}
 
-		new_data = data.copy()
-		overlaps_with = []
+		return self._format_annotations(annotations, simplify, exclude_duf, ignore_re = ignore_re)
 		
-		for i in range(len(data['Interval'])):
-			curr_interval = data['Interval'][i]
-			overlap_range = curr_interval+interval
-			if (curr_interval[1]-curr_interval[0])+(interval[1]-interval[0]) > max(overlap_range)-min(overlap_range):
-				# they overlap
-				overlaps_with.append(i)
-				
-				if curr_interval[1]-curr_interval[0] > interval[1]-interval[0]:
-					if not any(ext in data['Annotation'][i] for ext in ignore):
-					   annotation = data['Annotation'][i]
-					
-				interval = [min(overlap_range), max(overlap_range)]
-			
-		new_data = {key: [data[key][i] for i in range(len(data[key])) if i not in overlaps_with] for key in data}
-		new_data['Annotation'].append(annotation)
-		new_data['Interval'].append(interval)
-
-		return new_data
+	def _merge_intervals(self, annotations, intervals, ignore_re):
+		# merges all the overlapping intervals of an entry, at once. The merged 
+		# intervals are kept sorted by start, so the ones a new interval overlaps
+		# are found by bisection instead of scanning all of them. As merged intervals
+		# never overlap each other, only the last one starting before the new interval
+		# can reach into it. Each interval keeps the order it was added in, which 
+		# decides the annotation kept when merging and the order of the output
+		# interpro_db_diggested._merge_intervals in extract_interpro.py is a copy of this merge,
+		# as each module stands on its own: keep both in sync
+		starts = self._starts_buf
+		merged = self._merged_buf # [start, end, order, annotation], sorted by start
+		starts.clear()
+		merged.clear()
+		for order, (annotation, interval) in enumerate(zip(annotations, intervals)):
+			start, end = interval
+			overlaps_with = []
+
+			if end > start:
+				first = bisect.bisect_left(starts, start)
+				last = bisect.bisect_left(starts, end)
+
+				i = first - 1
+				while i >= 0 and merged[i][1] <= merged[i][0]:
+					i -= 1 # empty intervals never overlap anything
+				if i >= 0 and merged[i][1] > start:
+					overlaps_with.append(i)
+
+				overlaps_with += [i for i in range(first, last) if merged[i][1] > merged[i][0]]
+
+			for i in sorted(overlaps_with, key = lambda i: merged[i][2]):
+				curr_start, curr_end, _, curr_annotation = merged[i]
+				if curr_end-curr_start > end-start:
+					if not ignore_re.search(curr_annotation):
+						annotation = curr_annotation
+
+				start, end = min(curr_start, start), max(curr_end, end)
+
+			for i in reversed(overlaps_with):
+				del starts[i]
+				del merged[i]
+
+			i = bisect.bisect_right(starts, start)
+			starts.insert(i, start)
+			merged.insert(i, [start, end, order, annotation])
+
+		merged.sort(key = operator.itemgetter(2))
+		return {'Annotation': [m[3] for m in merged], 'Interval': [[m[0], m[1]] for m in merged]}
 	
-	def _format_annotations(self, data, simplify, exclude_duf, ignore):
+	def _format_annotations(self, data, simplify, exclude_duf, ignore_re):
 
 		if len(data['Annotation']) > 0:
-			annotations = []
-			for annotation in set(data['Annotation']):
-				if not exclude_duf or not any(ext in annotation for ext in ignore):
-					if simplify:
-						curr_lst = tuple(tuple(data['Interval'][i]) for i in range(len(data['Annotation'])) if data['Annotation'][i] == annotation)
-					else:
-						curr_lst = tuple([annotation] + [tuple(data['Interval'][i]) for i in range(len(data['Annotation'])) if data['Annotation'][i] == annotation])
-					annotations.append(curr_lst)
-			return tuple(annotations)
+			# intervals grouped per annotation in a single pass, in order of appearance
+			groups = {}
+			for annotation, interval in zip(data['Annotation'], data['Interval']):
+				if annotation in groups:
+					groups[annotation].append(tuple(interval))
+				elif not exclude_duf or not ignore_re.search(annotation):
+					groups[annotation] = [tuple(interval)]
+			if simplify:
+				return tuple(tuple(curr_intervals) for curr_intervals in groups.values())
+			return tuple(tuple([annotation] + curr_intervals) for annotation, curr_intervals in groups.items())
 		else:
 			return None
 
@@ -526,13 +1082,12 @@ class coverages_processor(data_extractor_base):
 
 		if 'ANNO' in entry_uniparc:
 			curr_len = entry_uniparc['LEN']
-			self.domains_cov, curr_intervals = self._compute_coverage(entry_uniparc['ANNO'], curr_len)
-			self.domains_cov_noDuff, curr_intervals = self._compute_coverage(entry_uniparc['ANNO'], curr_len, exclude_duf = True)
+			self.domains_cov, self.domains_cov_noDuff, curr_intervals = self._compute_coverage(entry_uniparc['ANNO'], curr_len)
 			all_intervals += curr_intervals
 
 		if len(all_intervals) > 0:
-			all_intervals = self._update_intervals(all_intervals, [], mode = 'multiple')
-			self.full_coverage, all_intervals = self._compute_coverage(all_intervals, curr_len) # all intervals already excludes dufs
+			# all intervals already excludes dufs
+			self.full_coverage = round(float(_covered_length(np.array(all_intervals, dtype = np.int64)))*100/curr_len, 2)
 
 		entry_uniparc = self.register(entry_uniparc)
 		
@@ -542,32 +1097,20 @@ class coverages_processor(data_extractor_base):
 		entry_uniprot[self.id()] = {'CC': self.cc_cov, 'IDP': self.dis_cov, 'DOMAINS': self.domains_cov, 'DOMAINS_noDUF': self.domains_cov_noDuff, 'FAMILIES': self.families_cov, 'FULL_noDUF': self.full_coverage}		
 		return entry_uniprot
 	
-	def _compute_coverage(self, intervals, length, exclude_duf = False, ignore = ['Putative','DUF','Uncharacter','pothetical', 'nknown']):
-
-		try:
-			if exclude_duf:
-				intervals = [anno for anno in intervals if not any(ext in anno[0] for ext in ignore)]
-			intervals = [anno[i] for anno in intervals for i in range(len(anno)) if not isinstance(anno[i][0], str)]
-			return round(sum([anno[1]-anno[0] for anno in intervals])*100/length, 2), intervals
-		except:
-			return round(sum([anno[1]-anno[0] for anno in intervals])*100/length, 2), intervals
-	
-	def _update_intervals(self, interval, data, mode = 'single'):
-
-		interval = np.array(interval)
-		interval.sort(axis=0)
-
-		new_data = []
-		for curr_interval in interval:
-			curr_interval = list(curr_interval)
-			if len(new_data) == 0:
-				new_data.append(curr_interval)
-			else:
-				previous_interval = list(new_data[-1])
-				if curr_interval[0] <= previous_interval[1]:
-					overlap_range = curr_interval+previous_interval
-					new_data[-1] = [min(overlap_range), max(overlap_range)]
-				else:
-					new_data.append(curr_interval)
-
-		return new_data
\ No newline at end of file
+	def _compute_coverage(self, annotations, length, ignore = ['Putative','DUF','Uncharacter','pothetical', 'nknown']):
+		# coverage of all the annotations, and of those not matching *ignore* along
+		# with their intervals, in a single pass. Annotations are (name, interval, ...),
+		# or only the intervals if simplified, in which case none is ignored
+		ignore_re = _compile_ignore(ignore)
+		named = len(annotations) > 0 and isinstance(annotations[0][0], str)
+		covered = 0
+		covered_noDuff = 0
+		intervals = []
+		for anno in annotations:
+			curr_intervals = anno[1:] if named else anno
+			curr_covered = sum([end - start for start, end in curr_intervals])
+			covered += curr_covered
+			if not named or not ignore_re.search(anno[0]):
+				covered_noDuff += curr_covered
+				intervals.extend(curr_intervals)
+		return round(covered*100/length, 2), round(covered_noDuff*100/length, 2), intervals
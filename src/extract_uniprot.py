@@ -3,20 +3,269 @@ import json
 import sys
 import time
 import gzip
-import io
+import codecs
 import re
 import pickle
+import resource
+import zlib
+import bisect
+import itertools
+import operator
+import subprocess
+import collections
+import multiprocessing
+import threading
+import queue
 import pymongo
 
 try:
     import psutil
-except:
-    pass
+except ImportError:
+    psutil = None
 
 import numpy as np
 
+# zstandard is optional, it is only needed when the entries stored in List mode
+# are compressed with compression = 'zstd'. A dictionary is then trained on the
+# first entries stored, so that the keys and values that repeat across entries
+# are not stored over and over
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# entries stored in List mode are encoded with a single, compact json encoder.
+# orjson is not an option here, as it writes the NaN coverages as null and 
+# cannot decode them back
+# The coiled coil and disorder intervals are kept as arrays until then, and 
+# written as lists
+_json_encoder = json.JSONEncoder(separators = (',', ':'), default = lambda obj: obj.tolist())
+
+def _dumps(obj):
+    return _json_encoder.encode(obj).encode()
+
+def _plain(data):
+    # *data* with its interval arrays as lists, for the encoders that only know
+    # python types
+    return {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in data.items()}
+
+# with compression = 'batch', entries stored in List mode are compressed together
+# in batches of this size
+_BATCH_SIZE = 256
+
+_ZSTD_DICT_SAMPLES = 1000
+_ZSTD_DICT_SIZE = 100000
+
 pid = os.getpid()
 
+_rss = {'proc': None, 'time': 0, 'gb': 0}
+
+def rss_gb():
+    # RSS memory used by the process, in GB. It is asked for in the main loops,
+    # so the process handle is reused and the value is sampled at most once per second.
+    # Without psutil, the peak RSS is reported, which is a single getrusage call
+    now = time.monotonic()
+    if now - _rss['time'] > 1:
+        if psutil is None:
+            _rss['gb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024/1024, 3)
+        else:
+            if _rss['proc'] is None:
+                _rss['proc'] = psutil.Process(pid)
+            _rss['gb'] = round(_rss['proc'].memory_info().rss/1024/1024/1024, 3)
+        _rss['time'] = now
+    return _rss['gb']
+
+def _gz_blocks(path, block_size = 1<<22):
+    """Yields the decompressed content of a gzipped file, in blocks of bytes. 
+    Decompression is piped through ``unpigz``, which inflates on a separate 
+    process (and threads), and falls back to :mod:`gzip` if pigz is not installed.
+
+    :param path: Path to the .gz file
+    :type path: :class:`str`
+    """
+    try:
+        proc = subprocess.Popen(['unpigz', '-c', path], stdout = subprocess.PIPE, bufsize = 1<<22)
+    except FileNotFoundError:
+        with gzip.open(path, 'rb') as fh:
+            yield from iter(lambda: fh.read(block_size), b'')
+        return
+
+    with proc:
+        yield from iter(lambda: proc.stdout.read(block_size), b'')
+    if proc.returncode != 0:
+        raise RuntimeError('unpigz failed to decompress {} (exit code {})'.format(path, proc.returncode))
+
+_ignore_res = {}
+
+def _compile_ignore(ignore):
+    # single regex to check if an annotation contains any of the terms in *ignore*.
+    # It is asked for every entry, so it is compiled once per list of terms
+    key = tuple(ignore)
+    if key not in _ignore_res:
+        if len(ignore) == 0:
+            _ignore_res[key] = re.compile('(?!)') # never matches
+        else:
+            _ignore_res[key] = re.compile('|'.join(re.escape(ext) for ext in ignore))
+    return _ignore_res[key]
+
+class _entry_rows(list):
+    """The rows of an entry. :func:`_entry_codes` groups them by line code once,
+    so each extractor only goes through the rows of the codes it needs instead
+    of testing all the rows of the entry.
+    """
+    codes = None
+    features = None
+    canonical = None
+
+_line_code = operator.itemgetter(slice(0, 2))
+
+# the following is a regex pattern which identifies uniprot accession 
+# codes stolen from https://www.uniprot.org/help/accession_numbers
+_AC_RE = re.compile('[OPQ][0-9][A-Z0-9]{3}[0-9]|[A-NR-Z][0-9]([A-Z][A-Z0-9]{2}[0-9]){1,2}')
+
+def _entry_codes(entry):
+    # the rows of *entry* by line code (their first two characters), and the
+    # index of the first row of each code. Rows of the same code come one after
+    # the other in uniprot entries, so they are grouped at C level
+    codes = getattr(entry, 'codes', None)
+    if codes is None:
+        rows = {}
+        first = {}
+        i = 0
+        for code, group in itertools.groupby(entry, _line_code):
+            group = list(group)
+            if code in rows:
+                rows[code] += group
+            else:
+                rows[code] = group
+                first[code] = i
+            i += len(group)
+        codes = (rows, first)
+        if isinstance(entry, _entry_rows):
+            entry.codes = codes
+    return codes
+
+def _rows_with_code(entry, code):
+    # the rows of *entry* starting with *code*, in order
+    return _entry_codes(entry)[0].get(code, ())
+
+def _rows_from_code(entry, code):
+    # the rows of *entry* from the first one starting with *code* to the end
+    first = _entry_codes(entry)[1]
+    if code not in first:
+        return ()
+    return itertools.islice(entry, first[code], None)
+
+class _prefetched_interpro:
+    """The interpro entries of a window of accession codes, fetched with a single
+    query and then answered one by one as :func:`interpro_db_diggested.query` does.
+    """
+    def __init__(self, docs):
+        self.docs = {doc['_id']: doc for doc in docs}
+
+    def query(self, ac):
+        if ac in self.docs:
+            return [self.docs[ac]]
+        return []
+
+def _prefetch_interpro(extracted, interpro_db, window = 1000):
+    # the (accession code, entry data) pairs in *extracted*, along with the 
+    # interpro entries needed for their coverages. These are queried for a 
+    # window of entries at a time, instead of once per entry
+    for batch in iter(lambda: list(itertools.islice(extracted, window)), []):
+        acs = [uniprot_ac for uniprot_ac, entry_data in batch if entry_data is not None]
+        prefetched = _prefetched_interpro(interpro_db.query_many(acs) if len(acs) > 0 else [])
+        for uniprot_ac, entry_data in batch:
+            yield uniprot_ac, entry_data, prefetched
+
+def _feature_rows(entry, key):
+    # the FT rows of *entry* opening a feature of type *key*, e.g. 'COILED'. The 
+    # FT rows are grouped by feature type once per entry, so each extractor only
+    # goes through the features it reads
+    features = getattr(entry, 'features', None)
+    if features is None:
+        features = {}
+        for line in _rows_with_code(entry, 'FT'):
+            if line[5:6] != ' ':
+                feature = line[5:].split(None, 1)[0]
+                if feature in features:
+                    features[feature].append(line)
+                else:
+                    features[feature] = [line]
+        if isinstance(entry, _entry_rows):
+            entry.features = features
+    return features.get(key, ())
+
+def _extract_entry(entry, ac_extractor, data_extractors, targets):
+    # the accession code of *entry* and the data of all its extractors, None
+    # if the entry is not a target
+    uniprot_ac = ac_extractor.extract(entry)
+
+    if uniprot_ac is None:
+        raise RuntimeError('Observed None uniprot AC')
+
+    if targets != 'all' and uniprot_ac not in targets:
+        return uniprot_ac, None
+
+    entry_data = dict()
+    for extractor in data_extractors:
+        data = extractor.extract(entry)
+        if data is not None:
+            entry_data[extractor.id()] = data
+    return uniprot_ac, entry_data
+
+# the extractors and targets of the worker processes, set once per process
+# when the pool starts
+
+_worker_args = None
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+def _extract_batch(entries):
+    return [_extract_entry(entry, *_worker_args) for entry in entries]
+
+def _canonical_sequence(entry):
+    # the sequence length and canonical sequence of *entry*, read and checked once
+    # per entry, and shared by the sequence length, sequence and family extractors
+    canonical = getattr(entry, 'canonical', None)
+    if canonical is None:
+        n_AA = None
+        in_sq = False
+        seq_parts = None
+        # nothing before the SQ row matters
+        for line in _rows_from_code(entry, 'SQ'):
+            if in_sq:
+                if line[:2] != '  ':
+                    in_sq = False # done reading sequence
+                else:
+                    seq_parts.append(line)
+            if line.startswith('SQ   '):
+                if seq_parts is not None:
+                    raise RuntimeError('Expect one canonical seq per entry')
+                seq_parts = []
+                in_sq = True
+                n_AA = int(line.split()[2])
+        # the spaces of all the sequence rows are removed at once
+        canonical_seq = None if seq_parts is None else ''.join(seq_parts).replace(' ', '')
+        if canonical_seq and n_AA != len(canonical_seq):
+            raise RuntimeError('Invalid seq length observed')
+        canonical = (n_AA, canonical_seq)
+        if isinstance(entry, _entry_rows):
+            entry.canonical = canonical
+    return canonical
+
+# the marks of uncertain positions in FT locations, e.g. <1..>120, removed before
+# reading the positions
+_FT_POSITION = str.maketrans('', '', '<>?')
+
+def _ft_interval(line):
+    # the positions of the location of an FT row, i.e. its last field, which may
+    # come after the accession code of an isoform (e.g. P12345-2:10..20)
+    location = line.rpartition(' ')[2].rpartition(':')[2]
+    return [int(i) for i in location.translate(_FT_POSITION).split('..')]
+
 class data_extractor_base:
     """Base class defining the interface for data extraction from uniprot 
     entries in text format. Children must implement :func:`id` and 
@@ -47,7 +296,17 @@ class uniprot_extractor:
     calling :func:`extract`.
     
     """
-    def __init__(self, mongo_host = None, mongo_port = None, name = 'UniProt'):
+    def __init__(self, mongo_host = None, mongo_port = None, name = 'UniProt', compression = 'gzip', fast_insert = False):
+
+        if compression not in ['gzip', 'batch', 'zstd']:
+            raise ValueError('compression must be either gzip, batch or zstd')
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstandard is required for compression = zstd')
+        self.compression = compression
+        self.zstd_dict = None
+        self.pending = list()
+        self.fast_insert = fast_insert
+        self._empty_batches()
 
         if mongo_host is None or mongo_port is None:
             self.data = list()
@@ -56,9 +315,9 @@ class uniprot_extractor:
         else:
             self.client = pymongo.MongoClient(mongo_host, mongo_port)
             self.db = self.client['Joana'] 
-            self.col = self.db[name]
-            self.type = 'Mongo'
             self.name = name
+            self.col = self._collection()
+            self.type = 'Mongo'
 
         self.data_extractors = list()
         self.ac_extractor = ac_extractor()
@@ -72,11 +331,13 @@ class uniprot_extractor:
         """
         if self.type == 'Mongo':
             self.col.drop()
-            self.col = self.db[self.name]
+            self.col = self._collection()
 
         elif self.type == 'List':
             self.data = list()
             self.entries = list()
+            self.pending = list()
+            self._empty_batches()
 
     def register(self, extractor):
         """Register new data extractor. In the data extraction phase, all 
@@ -87,7 +348,7 @@ class uniprot_extractor:
         """
         self.data_extractors.append(extractor)
 
-    def extract(self, uniprot_data, max_size = 'all', add_if_empty=True, clear = True, targets = 'all', chunk_size = 1000, print_step = 100000, saveto = None, savestep = 100000, interpro_db = None, process_coverages = True):
+    def extract(self, uniprot_data, max_size = 'all', add_if_empty=True, clear = True, targets = 'all', chunk_size = 1000, print_step = 100000, saveto = None, savestep = 100000, interpro_db = None, process_coverages = True, n_processes = 1, checkpoints = 'pickle'):
         """Process all entries in file(s) specified in *uniprot_data* with 
         registered data extractors.
         The data stored for a single entry is a dict with the return value of
@@ -105,10 +366,24 @@ class uniprot_extractor:
                              added to the per-entry data dicts. Thus, they might
                              be empty. If set to False, these dicts are ignored,
                              i.e. :func:`store` is not called for those.
+        :param n_processes: Number of worker processes running the registered
+                            data extractors on batches of entries. Entries are 
+                            still stored in the order of the file, by this 
+                            process. Default: 1, all in this process
+        :param checkpoints: How checkpoints are written in List mode when 
+                            *saveto* is given. 'pickle' saves the entries since
+                            the previous checkpoint to a new <saveto>_<count>.obj
+                            file. 'append' appends them to a single <saveto>.bin 
+                            file, to be read back with :func:`load`. Default: 'pickle'
 
         :type uniprot_data: :class:`str` / :class:`list` of :class:`str`
         :type add_if_empty: :class:`bool`
+        :type n_processes: :class:`int`
+        :type checkpoints: :class:`str`
         """
+        if checkpoints not in ['pickle', 'append']:
+            raise ValueError('checkpoints must be either pickle or append')
+        self.checkpoints = checkpoints
 
         if clear:
             self.clear()
@@ -118,33 +393,34 @@ class uniprot_extractor:
         self.curr_chunk_size = 0
         self.data_dict = list()
 
-        for entry in self._uniprot_entry_iterator(uniprot_data):
-            self.item_count += 1
-            data = None
+        if self.type == 'Mongo':
+            self._start_writer()
 
-            uniprot_ac = self.ac_extractor.extract(entry)
+        if n_processes > 1:
+            extracted = self._parallel_extracted_iterator(uniprot_data, n_processes, targets)
+        else:
+            extracted = (_extract_entry(entry, self.ac_extractor, self.data_extractors, targets) for entry in self._uniprot_entry_iterator(uniprot_data))
 
-            if uniprot_ac is None:
-                raise RuntimeError('Observed None uniprot AC')
+        if process_coverages and hasattr(interpro_db, 'query_many'):
+            with_interpro = _prefetch_interpro(extracted, interpro_db)
+        else:
+            with_interpro = ((uniprot_ac, entry_data, interpro_db) for uniprot_ac, entry_data in extracted)
 
-            if targets == 'all' or uniprot_ac in targets:
-                entry_data = dict()
-                for extractor in self.data_extractors:
-                    data = extractor.extract(entry)
-                    if data is not None:
-                        entry_data[extractor.id()] = data
-                
+        for uniprot_ac, entry_data, entry_interpro_db in with_interpro:
+            self.item_count += 1
+
+            if entry_data is not None:
                 if len(entry_data) > 0 or add_if_empty:    
                     if process_coverages:
-                        entry_data = self.coverages_processor.extract(entry_data, uniprot_ac, interpro_db) 
+                        entry_data = self.coverages_processor.extract(entry_data, uniprot_ac, entry_interpro_db) 
                         
                     self.store(uniprot_ac, entry_data)
 
                 if self.n_entries % print_step == 0:
                     if targets == 'all':
-                        print('UNIPROT:', uniprot_ac, self.item_count, self.n_entries, 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+                        print('UNIPROT:', uniprot_ac, self.item_count, self.n_entries, 'RSS memory used (GB):', rss_gb())
                     else:
-                        print('UNIPROT:', self.n_entries, 'out of {} targets'.format(len(targets)), 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+                        print('UNIPROT:', self.n_entries, 'out of {} targets'.format(len(targets)), 'RSS memory used (GB):', rss_gb())
                 
             if max_size != 'all' and self.item_count >= max_size:
                 break
@@ -153,14 +429,20 @@ class uniprot_extractor:
 
             if saveto is not None and self.item_count % savestep == 0:
                 self.save(saveto, self.item_count)
+        # stops the worker processes if the loop ended early
+        with_interpro.close()
+        extracted.close()
 
         if saveto is not None:
             self.save(saveto, self.item_count)
+        elif self.type == 'List':
+            self._flush_stored()
 
         if self.type == 'Mongo':
-            self.store(uniprot_ac, data, end = True)
+            self.store(None, None, end = True)
+            self._stop_writer()
 
-        print('UNIPROT:', self.item_count, self.n_entries, 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+        print('UNIPROT:', self.item_count, self.n_entries, 'RSS memory used (GB):', rss_gb())
         
     def store(self, ac, data, end = False):
 
@@ -179,41 +461,236 @@ class uniprot_extractor:
         """
 
         if self.type == 'List':
-            self.data.append(gzip.compress(json.dumps(data).encode()))
             self.entries.append(ac)
+            payload = _dumps(data)
+            if getattr(self, 'compression', 'gzip') == 'batch':
+                self.batch += len(payload).to_bytes(4, 'little')
+                self.batch += payload
+                self.batch_size += 1
+                if self.batch_size == _BATCH_SIZE:
+                    self._flush_batch()
+            elif getattr(self, 'compression', 'gzip') == 'zstd' and self.zstd_dict is None:
+                # kept aside until there are enough entries to train the dictionary
+                self.pending.append(payload)
+                if len(self.pending) == _ZSTD_DICT_SAMPLES:
+                    self._train_zstd_dict()
+            else:
+                self.data.append(self._compress(payload))
 
         elif self.type == 'Mongo':
             if not end:
-                self.data_dict.append({'_id': ac, 'data': data})
+                self.data_dict.append({'_id': ac, 'data': _plain(data)})
                 self.curr_chunk_size += 1
 
-            if self.curr_chunk_size == self.chunk_size or end:
-                try:
-                    self.col.insert_many(self.data_dict)
-                    self.data_dict = list()
-                    self.n_chunks += 1
-                    self.curr_chunk_size = 0
-                except:
-                    pass
+            if (self.curr_chunk_size == self.chunk_size or end) and len(self.data_dict) > 0:
+                # hand the batch over to the writer thread and keep parsing
+                if self._writer_error is not None:
+                    raise self._writer_error
+                self._queue.put(self.data_dict)
+                self.data_dict = list()
+                self.n_chunks += 1
+                self.curr_chunk_size = 0
                     
-        self.last_ac = ac
-        self.n_entries += 1
+        if not end:
+            self.last_ac = ac
+            self.n_entries += 1
     
                 
     ### METHODS FOR WHEN THE TYPE OF DB IS MONGO
 
+    def _start_writer(self):
+        # batches are inserted by a background thread, so that parsing overlaps
+        # with the writes to mongo. The queue is bounded to keep memory in check
+        self._queue = queue.Queue(maxsize = 4)
+        self._writer_error = None
+        self._writer = threading.Thread(target = self._drain, daemon = True)
+        self._writer.start()
+
+    def _stop_writer(self):
+        self._queue.put(None)
+        self._writer.join()
+        if self._writer_error is not None:
+            raise self._writer_error
+
+    def _drain(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                break
+            if self._writer_error is not None:
+                continue # keep consuming so that store() never blocks
+
+            # unordered, so that a failing document does not stop the rest of the batch
+            try:
+                self.col.insert_many(batch, ordered = False, bypass_document_validation = not self.fast_insert)
+            except pymongo.errors.BulkWriteError as e:
+                write_errors = e.details['writeErrors']
+                print(' ... WARNING: {} documents failed to be inserted. First error: {}'.format(len(write_errors), write_errors[0]['errmsg']))
+            except Exception as e:
+                self._writer_error = e
+
+    def _collection(self):
+        # with fast_insert, inserts are not acknowledged by the server (w = 0), see
+        # uniparc_extractor._collection for why document validation is then left on
+        col = self.db[self.name]
+        if self.fast_insert:
+            col = col.with_options(write_concern = pymongo.WriteConcern(w = 0))
+        return col
+
     def query(self, ac):
         return self.col.find({ '_id': ac })
 
-    def index_db(self):
-        self.col.create_index('_id')
+    def index_db(self, fields = []):
+        """Creates secondary indexes for *fields*, all in one call. Call it once all 
+        the data is inserted. The _id field is always indexed by MongoDB, so by 
+        default there is nothing to do.
+
+        :param fields: Fields to index, e.g. 'data.LEN'. Default: none
+        :type fields: :class:`list` of :class:`str`
+        """
+        if len(fields) > 0:
+            self.col.create_indexes([pymongo.IndexModel([(field, pymongo.ASCENDING)]) for field in fields])
         
     ### METHODS FOR WHEN THE TYPE OF DB IS LIST
-    
+
+    def iter_data(self):
+        """Yields the accession code and decoded data of the entries stored in 
+        List mode, whatever the compression they were stored with.
+
+        :returns: Pairs of accession code and entry data
+        :rtype: :class:`tuple` of :class:`str` and :class:`dict`
+        """
+        self._flush_stored()
+        if getattr(self, 'compression', 'gzip') != 'batch':
+            for ac, blob in zip(self.entries, self.data):
+                yield ac, self.decompress(blob)
+            return
+
+        for start, blob in zip(self.batch_starts, self.data):
+            for i, payload in enumerate(self._unpack_batch(blob)):
+                yield self.entries[start + i], json.loads(payload)
+
+    def get_data(self, index):
+        """Returns the decoded data of the entry stored in List mode at *index*,
+        i.e. of the accession code in entries[index].
+
+        :param index: Index of the entry
+        :type index: :class:`int`
+        :returns: The entry data
+        :rtype: :class:`dict`
+        """
+        self._flush_stored()
+        if getattr(self, 'compression', 'gzip') != 'batch':
+            return self.decompress(self.data[index])
+
+        if index < 0:
+            index += len(self.entries)
+        if index < 0 or index >= len(self.entries):
+            raise IndexError('index out of range')
+        batch = bisect.bisect_right(self.batch_starts, index) - 1
+        return json.loads(self._unpack_batch(self.data[batch])[index - self.batch_starts[batch]])
+
+    def decompress(self, blob):
+        """Decodes the data of an entry stored in List mode, i.e. an element of
+        *data*, with the compression the entries were stored with. With 
+        compression = 'batch', elements of *data* hold many entries, use 
+        :func:`get_data` instead.
+
+        :param blob: The compressed entry data
+        :type blob: :class:`bytes`
+        :returns: The entry data
+        :rtype: :class:`dict`
+        """
+        if getattr(self, 'compression', 'gzip') == 'zstd':
+            return json.loads(self._zstd_context(zstandard.ZstdDecompressor).decompress(blob))
+        return json.loads(gzip.decompress(blob))
+
+    def _compress(self, payload):
+        if self.compression == 'zstd':
+            return self._zstd_context(zstandard.ZstdCompressor).compress(payload)
+        return gzip.compress(payload)
+
+    def _train_zstd_dict(self):
+        # trains the dictionary on the entries kept aside, and stores them. Their
+        # accession codes are already in *entries*
+        try:
+            self.zstd_dict = zstandard.train_dictionary(_ZSTD_DICT_SIZE, self.pending).as_bytes()
+        except zstandard.ZstdError:
+            self.zstd_dict = b'' # too little data to train on, go without dictionary
+
+        for payload in self.pending:
+            self.data.append(self._compress(payload))
+        self.pending = list()
+
+    def _zstd_context(self, kind):
+        # (de)compression contexts are reused for all entries, and set up lazily
+        # as they can not be pickled
+        contexts = self.__dict__.setdefault('_zstd_contexts', {})
+        if kind not in contexts:
+            kwargs = {}
+            if len(self.zstd_dict) > 0:
+                kwargs['dict_data'] = zstandard.ZstdCompressionDict(self.zstd_dict)
+            if kind is zstandard.ZstdCompressor:
+                kwargs['level'] = 3
+            contexts[kind] = kind(**kwargs)
+        return contexts[kind]
+
+    def _flush_stored(self):
+        # compresses what is still kept aside: the current batch, or the entries 
+        # waiting for the zstd dictionary
+        self._flush_batch()
+        if len(getattr(self, 'pending', [])) > 0:
+            self._train_zstd_dict()
+
+    def _empty_batches(self):
+        # with compression = 'batch', the entries are framed with their length in
+        # 4 bytes and appended to *batch*. Each full batch is then compressed to an
+        # element of *data*, and *batch_starts* keeps the index of its first entry
+        self.batch = bytearray()
+        self.batch_size = 0
+        self.batch_starts = list()
+
+    def _flush_batch(self):
+        # a single deflate stream is reused for all the batches. It is fully flushed
+        # after each of them, so that every batch can be inflated on its own
+        if getattr(self, 'compression', 'gzip') != 'batch' or self.batch_size == 0:
+            return
+        if '_deflate' not in self.__dict__:
+            self._deflate = zlib.compressobj(6, zlib.DEFLATED, -15)
+        self.data.append(self._deflate.compress(self.batch) + self._deflate.flush(zlib.Z_FULL_FLUSH))
+        self.batch_starts.append(len(self.entries) - self.batch_size)
+        self.batch = bytearray()
+        self.batch_size = 0
+
+    @staticmethod
+    def _unpack_batch(blob):
+        batch = zlib.decompressobj(-15).decompress(blob)
+        payloads = []
+        offset = 0
+        while offset < len(batch):
+            size = int.from_bytes(batch[offset:offset+4], 'little')
+            payloads.append(batch[offset+4:offset+4+size])
+            offset += 4 + size
+        return payloads
+
+    def __getstate__(self):
+        # the deflate stream, the zstd contexts and the mongo writer can not be 
+        # pickled, they are set up again when needed
+        state = self.__dict__.copy()
+        for key in ['_deflate', '_zstd_contexts', '_queue', '_writer']:
+            state.pop(key, None)
+        return state
+
     def save(self, saveto, curr_count, clean = True):
 
-        self.checkpoint = '{}_{}.obj'.format(saveto, curr_count)
+        self._flush_stored()
+
         self.saved_index = curr_count
+        if self.type == 'List' and getattr(self, 'checkpoints', 'pickle') == 'append':
+            self._append_checkpoint(saveto)
+            return
+
+        self.checkpoint = '{}_{}.obj'.format(saveto, curr_count)
 
         print('\n ... Saving to: {}'.format(self.checkpoint))
         pickle.dump(self, open('{}'.format(self.checkpoint), 'wb'))
@@ -223,6 +700,68 @@ class uniprot_extractor:
         if clean:
             self.entries = list()
             self.data = list()
+            self._empty_batches()
+
+    def _append_checkpoint(self, saveto):
+        # the data stored since the previous checkpoint is appended to <saveto>.bin,
+        # each element of *data* framed with its length and its number of entries
+        # (1, or the size of the batch) in 4 bytes each, so that no checkpoint 
+        # rewrites what was already saved. <saveto>.obj only keeps the settings and
+        # is overwritten each time
+        self.checkpoint = '{}.bin'.format(saveto)
+
+        if getattr(self, 'compression', 'gzip') == 'batch':
+            counts = np.diff(self.batch_starts + [len(self.entries)])
+        else:
+            counts = np.ones(len(self.data), dtype = np.int64)
+
+        print('\n ... Appending to: {}'.format(self.checkpoint))
+        with open(self.checkpoint, 'ab') as outf:
+            outf.write(b''.join([len(blob).to_bytes(4, 'little') + int(count).to_bytes(4, 'little') + blob for blob, count in zip(self.data, counts)]))
+            outf.flush()
+            os.fsync(outf.fileno())
+
+        self.save_index(saveto)
+
+        # the data is on disk now, so it is always cleaned
+        self.entries = list()
+        self.data = list()
+        self._empty_batches()
+        with open('{}.obj'.format(saveto), 'wb') as outf:
+            pickle.dump(self, outf, protocol = pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(saveto):
+        """Loads the entries saved with checkpoints = 'append'.
+
+        :param saveto: The *saveto* the entries were extracted with
+        :type saveto: :class:`str`
+        :returns: The extractor, with all the saved entries
+        :rtype: :class:`uniprot_extractor`
+        """
+        with open('{}.obj'.format(saveto), 'rb') as inf:
+            db = pickle.load(inf)
+
+        with open('{}.bin'.format(saveto), 'rb') as inf:
+            content = inf.read()
+
+        db.data = list()
+        db.batch_starts = list()
+        offset = 0
+        n_entries = 0
+        while offset < len(content):
+            size = int.from_bytes(content[offset:offset+4], 'little')
+            count = int.from_bytes(content[offset+4:offset+8], 'little')
+            db.data.append(content[offset+8:offset+8+size])
+            if getattr(db, 'compression', 'gzip') == 'batch':
+                db.batch_starts.append(n_entries)
+            n_entries += count
+            offset += 8 + size
+
+        with open('{}.INDEX'.format(saveto)) as inf:
+            db.entries = [row.split('\t', 1)[0] for row in inf]
+
+        return db
 
     def save_index(self, saveto):
 
@@ -233,11 +772,10 @@ class uniprot_extractor:
         else:
             append_write = 'w' # make a new file if not
 
-        with open(saveto, append_write) as outf:
-            for uniprot_ac in self.entries:
-                outf.write('{}\t{}\n'.format(uniprot_ac, self.saved_index))
-
-        outf.close()
+        # the whole block is built at once and written in a single call
+        suffix = '\t{}\n'.format(self.saved_index)
+        with open(saveto, append_write, buffering = 1<<20) as outf:
+            outf.write(''.join([uniprot_ac + suffix for uniprot_ac in self.entries]))
         
     # HELPING METHODS
     
@@ -260,34 +798,79 @@ class uniprot_extractor:
         else:
             raise RuntimeError('uniprot_data must either be string or list of \
                                 strings referring to existing files')
-        # iterate and return entry by entry
-        current_entry = list()
-        current_entry_size = 0
-        for row in self._uniprot_file_iterator(files):
-            # if current_entry_size > max_entry_size:
-            #     raise RuntimeError('Observed Entry too large to process')
-            if row.startswith('//'):
-                if len(current_entry) > 0:
-                    yield current_entry
-                current_entry = list()
-                current_entry_size = 0
-            else:
-                current_entry.append(row)
-                current_entry_size += 1
-        if len(current_entry) > 0:
-            yield current_entry
-
-    def _uniprot_file_iterator(self, files):
+        # iterate and return entry by entry. Entries end at the rows starting with
+        # //, which are looked for in whole blocks of text; only complete rows are 
+        # parsed, the rest is carried over to the next block
+        text = ''
+        for block in self._uniprot_text_iterator(files):
+            text += block
+            end = text.rfind('\n') + 1
+            start = 0
+            while start < end:
+                if text.startswith('//', start):
+                    sep = start
+                else:
+                    sep = text.find('\n//', start, end) + 1
+                    if sep == 0:
+                        break
+                if sep > start:
+                    yield _entry_rows(map(str.rstrip, text[start:sep-1].split('\n')))
+                start = text.index('\n', sep) + 1
+            text = text[start:]
+        # the text always ends with a new line, so there is nothing left but the 
+        # rows of the last entry, if it is not followed by //
+        if len(text) > 0:
+            yield _entry_rows(map(str.rstrip, text[:-1].split('\n')))
+
+    def _parallel_extracted_iterator(self, uniprot_data, n_processes, targets, batch_size = 1000):
+        # batches of entries go through the data extractors on a pool of processes.
+        # Only a few batches are in flight at any time to keep memory bounded, and 
+        # they are returned in the order of the file
+        with multiprocessing.Pool(n_processes, initializer = _init_worker, initargs = (self.ac_extractor, self.data_extractors, targets)) as pool:
+            pending = collections.deque()
+            batch = list()
+            for entry in self._uniprot_entry_iterator(uniprot_data):
+                batch.append(entry)
+                if len(batch) == batch_size:
+                    pending.append(pool.apply_async(_extract_batch, (batch,)))
+                    batch = list()
+                    if len(pending) > 2*n_processes:
+                        yield from pending.popleft().get()
+            if len(batch) > 0:
+                pending.append(pool.apply_async(_extract_batch, (batch,)))
+
+            while len(pending) > 0:
+                yield from pending.popleft().get()
+
+    def _uniprot_text_iterator(self, files, block_size = 1<<22):
+        # the text of all the files, in blocks. Each file is decoded on its own, and 
+        # made to end with a new line so that no row runs into the next file.
+        # Decoding whole blocks takes the ascii fast path of the utf-8 codec, a
+        # fraction of the time spent splitting the rows, so the extractors keep
+        # getting rows as str rather than bytes
         for f in files:
             if f.endswith('.gz'):
-                with gzip.open(f, 'rb') as fh:
-                    with io.TextIOWrapper(fh, encoding='utf-8') as decoder:
-                        for row in decoder:
-                            yield row.rstrip() 
+                blocks = _gz_blocks(f, block_size = block_size)
             else:
-                with open(f) as fh:
-                    for row in fh:
-                        yield row.rstrip()
+                blocks = self._file_blocks(f, block_size)
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            last = ''
+            for block in blocks:
+                text = decoder.decode(block)
+                if len(text) > 0:
+                    last = text
+                    yield text
+            text = decoder.decode(b'', final = True)
+            if len(text) > 0:
+                last = text
+                yield text
+            if len(last) > 0 and not last.endswith('\n'):
+                yield '\n'
+
+    @staticmethod
+    def _file_blocks(f, block_size):
+        with open(f, 'rb') as fh:
+            yield from iter(lambda: fh.read(block_size), b'')
     
 
 class cc_extractor(data_extractor_base):
@@ -305,21 +888,19 @@ class cc_extractor(data_extractor_base):
     def extract(self, entry):
         """Implements functionality defined in :func:`data_extractor_base.extract`
 
-        :returns: Annotated coiled coil regions, None if no entries found
-        :rtype: :class:`list` of :class:`str`
+        :returns: Annotated coiled coil regions, one (start, end) per row, None 
+                  if no entries found
+        :rtype: :class:`numpy.ndarray`
         """
         cc_intervals = list()
-        for line in entry:
-                if line.startswith('FT   COILED'):
-                    if '?' not in line:
-                        line = line.replace(':',' ')
-                        interval = line.split()[-1].split('..')
-                        interval = [int(i.replace('<','').replace('>', '')) for i in interval]
-                        if len(interval) > 1:
-                            cc_intervals.append(interval)
+        for line in _feature_rows(entry, 'COILED'):
+            if '?' not in line:
+                interval = _ft_interval(line)
+                if len(interval) > 1:
+                    cc_intervals.append(interval)
 
         if len(cc_intervals) > 0:
-            return tuple(cc_intervals)
+            return np.array(cc_intervals, dtype = np.int32)
         else:
             return None
 
@@ -343,15 +924,12 @@ class tm_extractor(data_extractor_base):
         :rtype: :class:`list` of :class:`str`
         """
         tm_intervals = list()
-        for line in entry:
-                if line.startswith('FT   TRANSMEM'):
-                    if '?' not in line:
-                        line = line.replace(':',' ')
-                        interval = line.split()[-1].split('..')
-                        interval = [int(i.replace('<','').replace('>', '')) for i in interval]
-                        tm_intervals.append(interval)
-                    else:
-                        tm_intervals.append('UNK')
+        for line in _feature_rows(entry, 'TRANSMEM'):
+            if '?' not in line:
+                interval = _ft_interval(line)
+                tm_intervals.append(interval)
+            else:
+                tm_intervals.append('UNK')
 
         if len(tm_intervals) > 0:
             return tuple(tm_intervals)
@@ -378,15 +956,12 @@ class sp_extractor(data_extractor_base):
         :rtype: :class:`list` of :class:`str`
         """
         sp_intervals = list()
-        for line in entry:
-                if line.startswith('FT   SIGNAL'):
-                    if '?' not in line:
-                        line = line.replace(':',' ')
-                        interval = line.split()[-1].split('..')
-                        interval = [int(i.replace('<','').replace('>', '')) for i in interval]
-                        sp_intervals.append(interval)
-                    else:
-                        sp_intervals.append('UNK')
+        for line in _feature_rows(entry, 'SIGNAL'):
+            if '?' not in line:
+                interval = _ft_interval(line)
+                sp_intervals.append(interval)
+            else:
+                sp_intervals.append('UNK')
 
         if len(sp_intervals) > 0:
             return tuple(sp_intervals)
@@ -409,20 +984,21 @@ class disorder_extractor(data_extractor_base):
     def extract(self, entry):
         """Implements functionality defined in :func:`data_extractor_base.extract`
 
-        :returns: Annotated intrinsically disordered regions, None if no entries found
-        :rtype: :class:`list` of :class:`str`
+        :returns: Annotated intrinsically disordered regions, one (start, end) per
+                  row, None if no entries found
+        :rtype: :class:`numpy.ndarray`
         """
         idp_intervals = list()
-        for line in entry:
+        for line in _rows_with_code(entry, 'FT'):
                 if line.startswith('FT   REGION'):
                     interval = line.split()[2].split('..')
                 elif line.startswith('FT') and 'Disordered' in line:
-                    interval = [int(i.replace('<','').replace('>', '')) for i in interval]
+                    interval = [int(i.translate(_FT_POSITION)) for i in interval]
                     if len(interval) > 1:
                         idp_intervals.append(interval)
 
         if len(idp_intervals) > 0:
-            return tuple(idp_intervals)
+            return np.array(idp_intervals, dtype = np.int32)
         else:
             return None
 
@@ -445,13 +1021,11 @@ class ac_extractor(data_extractor_base):
         :returns: The uniprot accession code, None if not found
         :rtype: :class:`str`
         """
-        # the following is a regex pattern which identifies uniprot accession 
-        # codes stolen from https://www.uniprot.org/help/accession_numbers
-        ac_pat = '[OPQ][0-9][A-Z0-9]{3}[0-9]|[A-NR-Z][0-9]([A-Z][A-Z0-9]{2}[0-9]){1,2}'
-        for line in entry:
+        for line in _rows_with_code(entry, 'AC'):
             if line.startswith('AC   '):
-                ac = line.split()[1].strip(';')
-                if(re.match(ac_pat, ac)):
+                # only the first accession code of the row is needed
+                ac = line.split(None, 2)[1].strip(';')
+                if _AC_RE.match(ac):
                     return ac
         return None
 
@@ -473,26 +1047,7 @@ class seqlen_extractor(data_extractor_base):
         :returns: The canonical sequence, None if not found
         :rtype: :class:`str`
         """
-        n_AA = None
-        in_sq = False
-        sq_found = False
-        canonical_seq = None
-        for line in entry:
-            if in_sq:
-                if line[:2] != '  ':
-                    in_seq = False # done reading sequence
-                else:
-                    canonical_seq += line.replace(' ', '')
-            if line.startswith('SQ   '):
-                if sq_found:
-                    raise RuntimeError('Expect one canonical seq per entry')
-                canonical_seq = ''
-                in_sq = True
-                sq_found = True
-                n_AA = int(line.split()[2])
-        if canonical_seq and n_AA != len(canonical_seq):
-            raise RuntimeError('Invalid seq length observed')
-        return n_AA
+        return _canonical_sequence(entry)[0]
 
 class seq_extractor(data_extractor_base):
     """Implements interface defined in :class:`data_extractor_base` and extracts
@@ -512,26 +1067,7 @@ class seq_extractor(data_extractor_base):
         :returns: The canonical sequence, None if not found
         :rtype: :class:`str`
         """
-        n_AA = None
-        in_sq = False
-        sq_found = False
-        canonical_seq = None
-        for line in entry:
-            if in_sq:
-                if line[:2] != '  ':
-                    in_seq = False # done reading sequence
-                else:
-                    canonical_seq += line.replace(' ', '')
-            if line.startswith('SQ   '):
-                if sq_found:
-                    raise RuntimeError('Expect one canonical seq per entry')
-                canonical_seq = ''
-                in_sq = True
-                sq_found = True
-                n_AA = int(line.split()[2])
-        if canonical_seq and n_AA != len(canonical_seq):
-            raise RuntimeError('Invalid seq length observed')
-        return canonical_seq
+        return _canonical_sequence(entry)[1]
 
 class taxid_extractor(data_extractor_base):
     """Implements interface defined in :class:`data_extractor_base` and extracts
@@ -554,12 +1090,14 @@ class taxid_extractor(data_extractor_base):
         species_name = ''
         taxid = None
         taxa = []
-        for line in entry:
+        for line in _rows_with_code(entry, 'OX'):
             if line.startswith('OX   '):
                 taxid = int(line.split()[1].split('_TaxID=')[-1].strip(';'))
-            elif line.startswith('OS   '):
+        for line in _rows_with_code(entry, 'OS'):
+            if line.startswith('OS   '):
                 species_name += ' '.join(line.split()[1:]).strip('.')
-            elif line.startswith('OC   '):
+        for line in _rows_with_code(entry, 'OC'):
+            if line.startswith('OC   '):
                 taxa += line.strip('OC   ').strip('.').split(';')
 
         species_name = species_name.replace(',', '.')
@@ -587,7 +1125,8 @@ class family_extractor(data_extractor_base):
         """
         families_intervals = []
         found_family = False
-        for line in entry:
+        # nothing before the first FT row matters
+        for line in _rows_from_code(entry, 'FT'):
             if line.startswith('FT   CHAIN') and '..' in line:
                 found_family = True
                 interval = line.split()[-1].split('..')
@@ -595,9 +1134,9 @@ class family_extractor(data_extractor_base):
                 if interval[0] == '?':
                     interval[0] = '1'
                 if interval[1] == '?':
-                    interval[1] = str(seqlen_extractor().extract(entry))
+                    interval[1] = str(_canonical_sequence(entry)[0])
                     
-                interval = [int(i.replace('<','').replace('>', '').replace('?', '')) for i in interval]
+                interval = [int(i.translate(_FT_POSITION)) for i in interval]
                 title = ''
                 
             elif found_family:
@@ -639,7 +1178,7 @@ class name_extractor(data_extractor_base):
         found_name = False
         is_fragment = False
         source = 'Reviewed'
-        for line in entry:
+        for line in _rows_with_code(entry, 'DE'):
             if line.startswith('DE   RecName') and not found_name:
                 found_name = True
                 name = line.strip().split('Full=')[1].split(' {')[0]
@@ -677,7 +1216,7 @@ class evidence_extractor(data_extractor_base):
         
         evidence, evidence_level = 0, 'Undefined'
         
-        for line in entry:
+        for line in _rows_with_code(entry, 'PE'):
             if line.startswith('PE   '):
                 evidence = line.strip(';').split(': ')[1]
                 evidence_level = int(line.split()[1].replace(':',''))
@@ -734,7 +1273,8 @@ class coverages_processor(data_extractor_base):
 
         if len(all_intervals) > 0:
             all_intervals = self._update_intervals(all_intervals, [], mode = 'multiple')
-            self.full_coverage, all_intervals =self._compute_coverage(all_intervals, curr_len) # all intervals already excludes dufs
+            # all intervals already excludes dufs
+            self.full_coverage = round(int((all_intervals[:, 1]-all_intervals[:, 0]).sum())*100/curr_len, 2)
         
         entry_uniprot = self.register(entry_uniprot)
         
@@ -745,35 +1285,36 @@ class coverages_processor(data_extractor_base):
         return entry_uniprot
     
     def _compute_coverage(self, intervals, length, exclude_duf = False, ignore = ['Putative','DUF','Uncharacter','pothetical', 'nknown']):
-        
+        # coverage of the intervals and the intervals themselves. Annotations are 
+        # (name, interval, ...), and those matching *ignore* are left out if 
+        # *exclude_duf*; plain (start, end) intervals are all kept
+        if isinstance(intervals, np.ndarray):
+            # coiled coil and disorder intervals, already one (start, end) per row
+            return round(int((intervals[:, 1]-intervals[:, 0]).sum())*100/length, 2), list(intervals)
+
         intervals = [anno for anno in intervals if len(anno)>1]
-        try:
-            if exclude_duf:
-                intervals = [anno for anno in intervals if not any(ext in anno[0] for ext in ignore)]
-            intervals = [anno[i] for anno in intervals for i in range(len(anno)) if not isinstance(anno[i][0], str)]
-            return round(sum([anno[1]-anno[0] for anno in intervals])*100/length, 2), intervals
-        except:
-            return round(sum([anno[1]-anno[0] for anno in intervals])*100/length, 2), intervals
+        if len(intervals) > 0 and isinstance(intervals[0][0], str):
+            ignore_re = _compile_ignore(ignore if exclude_duf else [])
+            intervals = [interval for anno in intervals if not ignore_re.search(anno[0]) for interval in anno[1:]]
+        return round(sum([interval[1]-interval[0] for interval in intervals])*100/length, 2), intervals
                 
     def _update_intervals(self, interval, data, mode = 'single'):
+        """Merges the overlapping (start, end) intervals in *interval*.
 
-        interval = [anno for anno in interval if len(anno)>1]
-        interval = np.array(interval)
-        interval.sort(axis=0)
-
-        new_data = []
-        for curr_interval in interval:
-            curr_interval = list(curr_interval)
-            if len(curr_interval) > 1:
-                if len(new_data) == 0:
-                    new_data.append(curr_interval)
-                else:
-                    previous_interval = list(new_data[-1])
-                    if curr_interval[0] <= previous_interval[1]:
-                        overlap_range = curr_interval+previous_interval
-                        new_data[-1] = [min(overlap_range), max(overlap_range)]
-                    else:
-                        new_data.append(curr_interval)
-
-        return new_data
+        :returns: The merged intervals, sorted by their start, one per row
+        :rtype: :class:`numpy.ndarray`
+        """
+        interval = np.array([anno for anno in interval if len(anno)>1], dtype = np.int64).reshape(-1, 2)
+        if len(interval) == 0:
+            return interval
+        interval = interval[np.argsort(interval[:, 0], kind = 'mergesort')]
+        starts = interval[:, 0]
+        ends = interval[:, 1]
+        # an interval opens a new group when it starts after the end of all the
+        # intervals before it
+        running_max = np.maximum.accumulate(ends)
+        new_group = np.concatenate(([True], starts[1:] > running_max[:-1]))
+        group_starts = np.flatnonzero(new_group)
+
+        return np.column_stack((starts[group_starts], np.maximum.reduceat(ends, group_starts)))
     
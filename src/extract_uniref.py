@@ -3,15 +3,22 @@ import json
 import sys
 import time
 import gzip
-import io
+import codecs
 import re
 import pickle
+import resource
+import mmap
+import itertools
+import collections
+import multiprocessing
+import threading
+import queue
 import pymongo
 
 try:
     import psutil
-except:
-    pass
+except ImportError:
+    psutil = None
 
 import urllib.parse
 import urllib.request
@@ -19,10 +26,244 @@ import subprocess as sp
 
 import numpy as np
 
+# rapidgzip (formerly pragzip) decompresses a single gzip stream in parallel
+# from within python. It is optional, we fall back to unpigz/gzip otherwise
+try:
+    import rapidgzip
+except ImportError:
+    try:
+        import pragzip as rapidgzip
+    except ImportError:
+        rapidgzip = None
+
+# deflate (libdeflate bindings) inflates small .gz files in one shot, faster than
+# zlib and without the start up cost of rapidgzip or unpigz. It is optional
+try:
+    import deflate
+except ImportError:
+    deflate = None
+
+# .gz files that inflate to less than this are inflated at once with deflate, 
+# if installed, as the whole content is then held in memory
+_SMALL_GZ_SIZE = 32*1024*1024
+
+# orjson encodes the entries stored in List mode much faster than json, and 
+# directly returns bytes. It is optional, we fall back to json otherwise
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode()
+    _loads = json.loads
+
+# zstandard is optional, it is only needed when the entries stored in List mode
+# are compressed with compression = 'zstd'. A dictionary is then trained on the
+# first entries stored, as the entries are short and share most of their keys
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_ZSTD_DICT_SAMPLES = 1000
+_ZSTD_DICT_SIZE = 100000
+
 pid = os.getpid()
 
+_rss = {'proc': None, 'time': 0, 'gb': 0}
+
+def rss_gb():
+    # RSS memory used by the process, in GB. It is asked for in the main loops,
+    # so the process handle is reused and the value is sampled at most once per second.
+    # Without psutil, the peak RSS is reported, which is a single getrusage call
+    now = time.monotonic()
+    if now - _rss['time'] > 1:
+        if psutil is None:
+            _rss['gb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024/1024, 3)
+        else:
+            if _rss['proc'] is None:
+                _rss['proc'] = psutil.Process(pid)
+            _rss['gb'] = round(_rss['proc'].memory_info().rss/1024/1024/1024, 3)
+        _rss['time'] = now
+    return _rss['gb']
+
+def _gz_blocks(path, block_size = 1<<22):
+    """Yields the decompressed content of a gzipped file, in blocks of bytes.
+    Files with a small decompressed size, as given by the gzip trailer, are 
+    inflated at once with ``deflate`` if installed. Otherwise,
+    decompression is done in parallel with ``rapidgzip`` if installed, or it is
+    piped through ``unpigz``, which inflates on a separate process (and threads),
+    and falls back to :mod:`gzip` if pigz is not installed either.
+
+    :param path: Path to the .gz file
+    :type path: :class:`str`
+    """
+    if deflate is not None and os.path.getsize(path) < _SMALL_GZ_SIZE:
+        with open(path, 'rb') as fh:
+            compressed = fh.read()
+        # the trailer holds the decompressed size (modulo 2**32) of the last member
+        content = None
+        if int.from_bytes(compressed[-4:], 'little') < _SMALL_GZ_SIZE:
+            try:
+                content = deflate.gzip_decompress(compressed)
+            except (ValueError, deflate.DeflateError):
+                content = None
+        # deflate may only inflate the first member of files with several gzip 
+        # members (e.g. bgzf). Then, its content does not match the size and crc
+        # in the trailer of the file, and it is left to the streaming decompressors
+        if content is not None and (len(content) & 0xffffffff != int.from_bytes(compressed[-4:], 'little') or 
+                                    deflate.crc32(content) != int.from_bytes(compressed[-8:-4], 'little')):
+            content = None
+        if content is not None:
+            # the blocks are views, not copies, of the decompressed content
+            content = memoryview(content)
+            yield from (content[i:i+block_size] for i in range(0, len(content), block_size))
+            return
+
+    if rapidgzip is not None:
+        # the uniref xml files are large, any gzip file works but pigz/bgzf-compressed 
+        # inputs give maximal parallelism. Leave half of the cores for parsing
+        with rapidgzip.open(path, parallelization = max(1, os.cpu_count()//2)) as fh:
+            yield from iter(lambda: fh.read(block_size), b'')
+        return
+
+    try:
+        proc = sp.Popen(['unpigz', '-c', path], stdout = sp.PIPE, bufsize = 1<<22)
+    except FileNotFoundError:
+        with gzip.open(path, 'rb') as fh:
+            yield from iter(lambda: fh.read(block_size), b'')
+        return
+
+    with proc:
+        yield from iter(lambda: proc.stdout.read(block_size), b'')
+    if proc.returncode != 0:
+        raise RuntimeError('unpigz failed to decompress {} (exit code {})'.format(path, proc.returncode))
+
+def _threaded(entries, maxsize = 256):
+    """Yields the items of the iterator *entries*, which runs on a background 
+    thread. Reading and grouping the rows of the next entries then overlaps with
+    the processing of the current one, which mostly waits on mongo. The queue 
+    is bounded to keep memory in check, and the thread stops as soon as the 
+    items are no longer consumed.
+
+    :param entries: The entries to yield, in order
+    :type entries: generator
+    """
+    items = queue.Queue(maxsize = maxsize)
+    stop = threading.Event()
+    end = object()
+    errors = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in entries:
+                if not put(item):
+                    break
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            entries.close()
+            put(end)
+
+    producer = threading.Thread(target = produce, daemon = True)
+    producer.start()
+    try:
+        while True:
+            item = items.get()
+            if item is end:
+                break
+            yield item
+        if len(errors) > 0:
+            raise errors[0]
+    finally:
+        stop.set()
+        producer.join()
+
 # UNIREF
 
+class _entry_rows(list):
+    """The rows of an entry. The entry iterator also keeps the text they were 
+    split from, so the extractors can scan it with a single regex instead of 
+    going through the rows in python.
+    """
+    text = None
+
+def _entry_text(entry):
+    # the text of an entry, joined back if it does not come from the entry iterator
+    text = getattr(entry, 'text', None)
+    if text is None:
+        text = '\n'.join(entry)
+    return text
+
+# the values the extractors look for, matched on the whole text of an entry. 
+# Rows are matched after their new line rather than with ^ and re.M, so that the
+# search skips ahead to the literal new line instead of trying every position.
+# _MEMBER_RE matches either a UniProtKB dbReference (group 1), the id of any other
+# dbReference (group 2) or the value of a UniProtKB property (group 3)
+_AC_RE = re.compile(r'(?:^|\n)<entry id=(?:"|[^\n]*?=")([^"\n]*)')
+_MEMBER_RE = re.compile(r'\n<(?:dbReference type=(?:([^\n]*UniProtKB)|[^\n]*?id=[^"\n]*"([^"\n]*))|property type=(?=[^\n]*UniProtKB)[^\n]*?value=[^"\n]*"([^"\n]*))')
+_UNIREF_RE = re.compile(r'\n<property type=(?=[^\n]*UniRef)[^\n]*?value=[^"\n]*"([^"\n]*)')
+
+class _mapped_bytes:
+    """Read only, list-like sequence of the entries saved with checkpoints = 
+    'append': slices of a memory mapped buffer, delimited by their offsets.
+    """
+    def __init__(self, buffer, offsets):
+        self.buffer = buffer
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('index out of range')
+        return self.buffer[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def _wanted(uniref_ac, in_db, targets):
+    # whether an entry is extracted: it has a valid accession code, it is not in
+    # the DB already, and it is a target
+    return uniref_ac is not None and not in_db and (targets == 'all' or uniref_ac in targets)
+
+def _extract_entry(entry, extractors):
+    # the data of all the extractors for *entry*. *extractors* are the (id, 
+    # extract method) pairs of the data extractors, looked up once per extract call
+    entry_data = dict()
+    for extractor_id, extract in extractors:
+        data = extract(entry)
+        if data is not None:
+            entry_data[extractor_id] = data
+    return entry_data
+
+# the extractors of the worker processes, set once per process when the pool starts
+
+_worker_args = None
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+def _extract_batch(batch):
+    return [(uniref_ac, None if text is None else _extract_entry(uniref_extractor._entry_rows(text), *_worker_args)) for uniref_ac, text in batch]
+
 class data_extractor_base:
     """Base class defining the interface for data extraction from uniprot 
     entries in text format. Children must implement :func:`id` and 
@@ -53,8 +294,16 @@ class uniref_extractor:
     calling :func:`extract`.
     """
 
-    def __init__(self, mongo_host = None, mongo_port = None, name = 'UniRef50'):
+    def __init__(self, mongo_host = None, mongo_port = None, name = 'UniRef50', compression = 'gzip', fast_insert = False):
 
+        if compression not in ['gzip', 'zstd']:
+            raise ValueError('compression must be either gzip or zstd')
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstandard is required for compression = zstd')
+        self.compression = compression
+        self.zstd_dict = None
+        self.pending = list()
+        self.fast_insert = fast_insert
         if mongo_host is None or mongo_port is None:
             self.data = list()
             self.entries = list()
@@ -62,9 +311,9 @@ class uniref_extractor:
         else:
             self.client = pymongo.MongoClient(mongo_host, mongo_port)
             self.db = self.client['Joana'] 
-            self.col = self.db[name]
-            self.type = 'Mongo'
             self.name = name
+            self.col = self._collection()
+            self.type = 'Mongo'
 
         self.data_extractors = list()
         self.ac_extractor = ac_extractor()
@@ -79,12 +328,13 @@ class uniref_extractor:
         if self.type == 'Mongo':
             print(' ... ... Cleaning DB')
             self.col.drop()
-            self.col = self.db[self.name]
+            self.col = self._collection()
             print(' ... ... Done!')
 
         elif self.type == 'List':
             self.data = list()
             self.entries = list()
+            self.pending = list()
 
     def register(self, extractor):
         """Register new data extractor. In the data extraction phase, all 
@@ -95,7 +345,7 @@ class uniref_extractor:
         """
         self.data_extractors.append(extractor)
 
-    def extract(self, uniref_data, add_if_empty=True, clear = True, max_size = 'all', targets = 'all', chunk_size = 1000, print_step = 100000, saveto = None, savestep = 100000, uniprot_db = None, uniparc_db = None, alphafold_db = None, update_unip = False):
+    def extract(self, uniref_data, add_if_empty=True, clear = True, max_size = 'all', targets = 'all', chunk_size = 10000, print_step = 100000, saveto = None, savestep = 100000, uniprot_db = None, uniparc_db = None, alphafold_db = None, update_unip = False, n_processes = 1, checkpoints = 'pickle'):
         """Process all entries in file(s) specified in *uniref_data* with 
         registered data extractors.
         The data stored for a single entry is a dict with the return value of
@@ -114,12 +364,32 @@ class uniref_extractor:
                              i.e. :func:`store` is not called for those.
         :param max_size:	 Maximum number of elements to extract. Default: all
         :param targets:	  Target accession codes to extract. Default: all
+        :param chunk_size:   Number of entries per insert into Mongo, and per
+                             bulk update of the UniProt, UniParc and AlphaFold
+                             collections when *update_unip* is set. Batches
+                             larger than the server limits are split by pymongo.
+        :param n_processes:  Number of worker processes running the registered
+                             data extractors on batches of entries. The darkness
+                             and the Mongo queries and writes stay in this process,
+                             and entries are stored in the order of the file. 
+                             Default: 1, all in this process
+        :param checkpoints:  How checkpoints are written in List mode when 
+                             *saveto* is given. 'pickle' saves the entries since
+                             the previous checkpoint to a new <saveto>_<count>.obj
+                             file. 'append' appends them to a single <saveto>.bin 
+                             file, to be read back with :func:`load`. Default: 'pickle'
 
         :type uniref_data: :class:`str` / :class:`list` of :class:`str`
         :type add_if_empty: :class:`bool`
         :type max_size: :class:`int`
         :type targets: :class:`str` / :class:`list` of :class:`str`
+        :type chunk_size: :class:`int`
+        :type n_processes: :class:`int`
+        :type checkpoints: :class:`str`
         """
+        if checkpoints not in ['pickle', 'append']:
+            raise ValueError('checkpoints must be either pickle or append')
+        self.checkpoints = checkpoints
 
         if clear:
             self.clear()
@@ -128,40 +398,42 @@ class uniref_extractor:
         self.n_chunks = 0
         self.curr_chunk_size = 0
         self.data_dict = list()
+        self.uniprot_pending = list()
+        self.uniparc_pending = list()
+        self.af_pending = list()
+        self.n_pending = 0
+
+        entries = _threaded(self._uniref_entry_iterator(uniref_data))
+        checked = self._checked_entry_iterator(entries, chunk_size)
+        extractors = [(extractor.id(), extractor.extract) for extractor in self.data_extractors]
+        if n_processes > 1:
+            extracted = self._parallel_extracted_iterator(checked, n_processes, extractors, targets)
+        else:
+            extracted = ((uniref_ac, _extract_entry(entry, extractors) if _wanted(uniref_ac, in_db, targets) else None) for entry, uniref_ac, in_db in checked)
 
-        for entry in self._uniref_entry_iterator(uniref_data):
+        for uniref_ac, entry_data in extracted:
             self.item_count += 1
-            data = None
-
-            uniref_ac = self.ac_extractor.extract(entry)
 
             # contine only if it is a valid UniRef identifier and it does not exist in the DB already
-            if uniref_ac is not None and self.query(uniref_ac).count() == 0: 
-                if targets == 'all' or uniref_ac in targets:
-                    entry_data = dict()
-                    for extractor in self.data_extractors:
-                        data = extractor.extract(entry)
-                        if data is not None:
-                            entry_data[extractor.id()] = data
-
-                    if len(entry_data) > 0 or add_if_empty:	
-                        entry_data = self.darkness_extractor.extract(entry_data, uniref_ac, uniprot_db, uniparc_db, alphafold_db)                         
-                        if update_unip and uniprot_db is not None and uniparc_db is not None:
-                            self.update_uniprot_and_uniparc(uniref_ac, entry_data, uniprot_db, uniparc_db, alphafold_db)
-                        
-                        self.store(uniref_ac, entry_data)
+            if entry_data is not None:
+                if len(entry_data) > 0 or add_if_empty:	
+                    entry_data = self.darkness_extractor.extract(entry_data, uniref_ac, uniprot_db, uniparc_db, alphafold_db)                         
+                    if update_unip and uniprot_db is not None and uniparc_db is not None:
+                        self.update_uniprot_and_uniparc(uniref_ac, entry_data, uniprot_db, uniparc_db, alphafold_db)
+                    
+                    self.store(uniref_ac, entry_data)
 
 #                     if self.n_entries % print_step == 0:
 #                         if targets == 'all':
-#                             print('UNIREF:', self.item_count, self.n_entries, 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+#                             print('UNIREF:', self.item_count, self.n_entries, 'RSS memory used (GB):', rss_gb())
 #                         else:
-#                             print('UNIREF:', self.item_count, self.n_entries, 'out of {} targets'.format(len(targets)), 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+#                             print('UNIREF:', self.item_count, self.n_entries, 'out of {} targets'.format(len(targets)), 'RSS memory used (GB):', rss_gb())
                 
             if self.item_count % print_step == 0:
                 if targets == 'all':
-                    print('UNIREF:', self.item_count, self.n_entries, 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+                    print('UNIREF:', self.item_count, self.n_entries, 'RSS memory used (GB):', rss_gb())
                 else:
-                    print('UNIREF:', self.item_count, self.n_entries, 'out of {} targets'.format(len(targets)), 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+                    print('UNIREF:', self.item_count, self.n_entries, 'out of {} targets'.format(len(targets)), 'RSS memory used (GB):', rss_gb())
 
             if max_size != 'all' and self.item_count >= max_size:
                 break
@@ -172,13 +444,24 @@ class uniref_extractor:
                 print(uniref_ac)
                 self.save(saveto, self.item_count)
 
+        # if the loop ended early: closing *extracted* shuts the worker processes
+        # down, and closing the entry iterators below it stops the reader thread
+        extracted.close()
+        checked.close()
+        entries.close()
+
         if saveto is not None:
             self.save(saveto, self.item_count)
+            self.wait_checkpoint()
 
         if self.type == 'Mongo':
-            self.store(uniref_ac, data, end = True)
+            self.store(uniref_ac, None, end = True)
+        else:
+            self._flush_stored()
+
+        self.flush_updates(uniprot_db, uniparc_db, alphafold_db)
 
-        print('UNIREF:', self.item_count, self.n_entries, 'RSS memory used (GB):', round(psutil.Process(pid).memory_info().rss/1024/1024/1024, 3))
+        print('UNIREF:', self.item_count, self.n_entries, 'RSS memory used (GB):', rss_gb())
 
 
     def store(self, ac, data, end = False):
@@ -198,7 +481,17 @@ class uniref_extractor:
         """
 
         if self.type == 'List':
-            self.data.append(gzip.compress(json.dumps(data).encode()))
+            if getattr(self, 'compression', 'gzip') == 'zstd':
+                payload = _dumps(data)
+                if self.zstd_dict is None:
+                    # kept aside until there are enough entries to train the dictionary
+                    self.pending.append(payload)
+                    if len(self.pending) == _ZSTD_DICT_SAMPLES:
+                        self._train_zstd_dict()
+                else:
+                    self.data.append(self._zstd_context(zstandard.ZstdCompressor).compress(payload))
+            else:
+                self.data.append(gzip.compress(_dumps(data)))
             self.entries.append(ac)
 
         elif self.type == 'Mongo':
@@ -206,32 +499,108 @@ class uniref_extractor:
                 self.data_dict.append({'_id': ac, 'data': data})
                 self.curr_chunk_size += 1
 
-            if self.curr_chunk_size == self.chunk_size or end:
+            if (self.curr_chunk_size == self.chunk_size or end) and len(self.data_dict) > 0:
+                # unordered, so that a failing document does not stop the rest of the batch
                 try:
-                    self.col.insert_many(self.data_dict)
-                    self.data_dict = list()
-                    self.n_chunks += 1
-                    self.curr_chunk_size = 0
-                except:
-                    pass
+                    self.col.insert_many(self.data_dict, ordered = False, bypass_document_validation = not self.fast_insert)
+                except pymongo.errors.BulkWriteError as e:
+                    write_errors = e.details['writeErrors']
+                    print(' ... WARNING: {} documents failed to be inserted. First error: {}'.format(len(write_errors), write_errors[0]['errmsg']))
+                self.data_dict = list()
+                self.n_chunks += 1
+                self.curr_chunk_size = 0
 
         self.last_ac = ac
         self.n_entries += 1
 
     ### METHODS FOR WHEN THE TYPE OF DB IS MONGO
 
+    def _collection(self):
+        # with fast_insert, inserts are not acknowledged by the server (w = 0), see
+        # uniparc_extractor._collection for why document validation is then left on
+        col = self.db[self.name]
+        if self.fast_insert:
+            col = col.with_options(write_concern = pymongo.WriteConcern(w = 0))
+        return col
+
     def query(self, ac):
-        return self.col.find({ '_id': { "$in": [ac] } })
+        return self.col.find({ '_id': ac })
+
+    def index_db(self, fields = []):
+        """Creates secondary indexes for *fields*, all in one call. Call it once all 
+        the data is inserted. The _id field is always indexed by MongoDB, so by 
+        default there is nothing to do.
 
-    def index_db(self):
-        self.col.create_index('_id')
+        :param fields: Fields to index, e.g. 'data.LEN'. Default: none
+        :type fields: :class:`list` of :class:`str`
+        """
+        if len(fields) > 0:
+            self.col.create_indexes([pymongo.IndexModel([(field, pymongo.ASCENDING)]) for field in fields])
 
     ### METHODS FOR WHEN THE TYPE OF DB IS LIST
 
+    def decompress(self, blob):
+        """Decodes the data of an entry stored in List mode, i.e. an element of
+        *data*, with the compression the entries were stored with.
+
+        :param blob: The compressed entry data
+        :type blob: :class:`bytes`
+        :returns: The entry data
+        :rtype: :class:`dict`
+        """
+        if getattr(self, 'compression', 'gzip') == 'zstd':
+            return _loads(self._zstd_context(zstandard.ZstdDecompressor).decompress(blob))
+        return _loads(gzip.decompress(blob))
+
+    def _train_zstd_dict(self):
+        # trains the dictionary on the entries kept aside, and stores them. Their
+        # accession codes are already in *entries*
+        try:
+            self.zstd_dict = zstandard.train_dictionary(_ZSTD_DICT_SIZE, self.pending).as_bytes()
+        except zstandard.ZstdError:
+            self.zstd_dict = b'' # too little data to train on, go without dictionary
+
+        compressor = self._zstd_context(zstandard.ZstdCompressor)
+        for payload in self.pending:
+            self.data.append(compressor.compress(payload))
+        self.pending = list()
+
+    def _zstd_context(self, kind):
+        # (de)compression contexts are reused for all entries, and set up lazily
+        # as they can not be pickled
+        contexts = self.__dict__.setdefault('_zstd_contexts', {})
+        if kind not in contexts:
+            kwargs = {}
+            if len(self.zstd_dict) > 0:
+                kwargs['dict_data'] = zstandard.ZstdCompressionDict(self.zstd_dict)
+            if kind is zstandard.ZstdCompressor:
+                kwargs['level'] = 3
+            contexts[kind] = kind(**kwargs)
+        return contexts[kind]
+
+    def _flush_stored(self):
+        # compresses the entries still waiting for the zstd dictionary
+        if len(getattr(self, 'pending', [])) > 0:
+            self._train_zstd_dict()
+
+    def __getstate__(self):
+        # the zstd contexts and the checkpoint writer can not be pickled, the 
+        # contexts are set up again when needed
+        state = self.__dict__.copy()
+        for key in ['_zstd_contexts', '_checkpoint_writer', '_checkpoint_error']:
+            state.pop(key, None)
+        return state
+
     def save(self, saveto, curr_count, clean = True):
 
-        self.checkpoint = '{}_{}.obj'.format(saveto, curr_count)
+        self._flush_stored()
+
         self.saved_index = curr_count
+        if self.type == 'List' and getattr(self, 'checkpoints', 'pickle') == 'append':
+            self._append_checkpoint(saveto)
+            return
+
+        self.checkpoint = '{}_{}.obj'.format(saveto, curr_count)
 
         print('\n ... Saving to: {}'.format(self.checkpoint))
         pickle.dump(self, open('{}'.format(self.checkpoint), 'wb'))
@@ -242,7 +611,89 @@ class uniref_extractor:
             self.entries = list()
             self.data = list()
 
+    def _append_checkpoint(self, saveto):
+        # the data stored since the previous checkpoint is appended to <saveto>.bin,
+        # and the offsets of the entries in it to <saveto>.offsets, so that no
+        # checkpoint rewrites what was already saved. <saveto>.obj only keeps the 
+        # settings (e.g. the zstd dictionary) and is overwritten each time
+        # The files are written on a background thread, so that extraction goes on
+        # in the meantime; the next checkpoint waits for it to be done
+        self.wait_checkpoint()
+        self.checkpoint = '{}.bin'.format(saveto)
+
+        # the data is handed over to the writer, so it is always cleaned
+        data, entries = self.data, self.entries
+        self.entries = list()
+        self.data = list()
+        with open('{}.obj'.format(saveto), 'wb') as outf:
+            pickle.dump(self, outf, protocol = pickle.HIGHEST_PROTOCOL)
+
+        self._checkpoint_writer = threading.Thread(target = self._write_checkpoint, args = (saveto, data, entries, self.saved_index))
+        self._checkpoint_writer.start()
+
+    def _write_checkpoint(self, saveto, data, entries, saved_index):
+        try:
+            print('\n ... Appending to: {}'.format('{}.bin'.format(saveto)))
+            with open('{}.bin'.format(saveto), 'ab') as outf:
+                base = outf.tell()
+                outf.write(b''.join(data))
+                outf.flush()
+                os.fsync(outf.fileno())
+
+            offsets = np.cumsum([0] + [len(blob) for blob in data], dtype = np.int64) + base
+            with open('{}.offsets'.format(saveto), 'ab') as outf:
+                # the leading 0 is only written once, when the file is created
+                if outf.tell() > 0:
+                    offsets = offsets[1:]
+                outf.write(offsets.tobytes())
+                outf.flush()
+                os.fsync(outf.fileno())
+
+            self._write_index(saveto, entries, saved_index)
+        except BaseException as e:
+            self._checkpoint_error = e
+
+    def wait_checkpoint(self):
+        """Waits for the checkpoint being written in the background with 
+        checkpoints = 'append', if any, and raises the error it failed with.
+        """
+        writer = self.__dict__.pop('_checkpoint_writer', None)
+        if writer is not None:
+            writer.join()
+        error = self.__dict__.pop('_checkpoint_error', None)
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def load(saveto):
+        """Loads the entries saved with checkpoints = 'append'. The data file is
+        memory mapped, so an entry is only read from disk when accessed, and the 
+        loaded object is read only.
+
+        :param saveto: The *saveto* the entries were extracted with
+        :type saveto: :class:`str`
+        :returns: The extractor, with all the saved entries
+        :rtype: :class:`uniref_extractor`
+        """
+        with open('{}.obj'.format(saveto), 'rb') as inf:
+            db = pickle.load(inf)
+
+        db.data = list()
+        if os.path.getsize('{}.bin'.format(saveto)) > 0:
+            with open('{}.bin'.format(saveto), 'rb') as inf:
+                buffer = mmap.mmap(inf.fileno(), 0, access = mmap.ACCESS_READ)
+            db.data = _mapped_bytes(buffer, np.memmap('{}.offsets'.format(saveto), dtype = np.int64, mode = 'r'))
+
+        with open('{}.INDEX'.format(saveto)) as inf:
+            db.entries = [row.split('\t', 1)[0] for row in inf]
+
+        return db
+
     def save_index(self, saveto):
+        self._write_index(saveto, self.entries, self.saved_index)
+
+    @staticmethod
+    def _write_index(saveto, entries, saved_index):
 
         print(' ... Saving indexes to: {}\n'.format('{}.INDEX'.format(saveto)))
         saveto = '{}.INDEX'.format(saveto)
@@ -251,11 +702,10 @@ class uniref_extractor:
         else:
             append_write = 'w' # make a new file if not
 
-        with open(saveto, append_write) as outf:
-            for uniref_ac in self.entries:
-                outf.write('{}\t{}\n'.format(uniref_ac, self.saved_index))
-
-        outf.close()
+        # the whole block is built at once and written in a single call
+        suffix = '\t{}\n'.format(saved_index)
+        with open(saveto, append_write, buffering = 1<<20) as outf:
+            outf.write(''.join([uniref_ac + suffix for uniref_ac in entries]))
 
     def _uniref_entry_iterator(self, uniref_ac, max_entry_size=1048576):
         # check input, uniref_ac must either be string or list of strings 
@@ -276,34 +726,105 @@ class uniref_extractor:
         else:
             raise RuntimeError('uniprot_data must either be string or list of \
                                 strings referring to existing files')
-        # iterate and return entry by entry
-        current_entry = list()
-        current_entry_size = 0
-        for row in self._uniref_file_iterator(files):
-            # if current_entry_size > max_entry_size:
-            # 	raise RuntimeError('Observed Entry too large to process')
-            if row.startswith('</entry>'):
-                if len(current_entry) > 0:
-                    yield current_entry
-                current_entry = list()
-                current_entry_size = 0
-            else:
-                current_entry.append(row)
-                current_entry_size += 1
-        if len(current_entry) > 0:
-            yield current_entry
-
-    def _uniref_file_iterator(self, files):
+        # iterate and return entry by entry. Entries end at the rows starting with
+        # </entry>, which are looked for in whole blocks of text; only complete rows
+        # are parsed, the rest is carried over to the next block. The rows are not
+        # stripped, the extractors only look at their start and at quoted values
+        text = ''
+        for block in self._uniref_text_iterator(files):
+            text += block
+            end = text.rfind('\n') + 1
+            start = 0
+            while start < end:
+                if text.startswith('</entry>', start):
+                    sep = start
+                else:
+                    sep = text.find('\n</entry>', start, end) + 1
+                    if sep == 0:
+                        break
+                if sep > start:
+                    yield self._entry_rows(text[start:sep-1])
+                start = text.index('\n', sep) + 1
+            text = text[start:]
+        # the text always ends with a new line, so there is nothing left but the 
+        # rows after the last entry, i.e. the closing tag of the file
+        if len(text) > 0:
+            yield self._entry_rows(text[:-1])
+
+    @staticmethod
+    def _entry_rows(text):
+        entry = _entry_rows(text.split('\n'))
+        entry.text = text
+        return entry
+
+    def _checked_entry_iterator(self, entries, window):
+        # the entries, with their accession code and whether it is in the DB 
+        # already. That is asked for a window of entries at a time, in a single
+        # query on the _id index, instead of once per entry. *entries* is closed
+        # when this is, so that a reader thread behind it stops right away
+        try:
+            for batch in iter(lambda: list(itertools.islice(entries, window)), []):
+                acs = [self.ac_extractor.extract(entry) for entry in batch]
+                in_db = set()
+                if self.type == 'Mongo':
+                    query = {'_id': {'$in': [ac for ac in acs if ac is not None]}}
+                    in_db = {document['_id'] for document in self.col.find(query, {'_id': 1})}
+                for entry, ac in zip(batch, acs):
+                    yield entry, ac, ac in in_db
+        finally:
+            if hasattr(entries, 'close'):
+                entries.close()
+
+    def _parallel_extracted_iterator(self, checked, n_processes, extractors, targets, batch_size = 1000):
+        # batches of entries go through the data extractors on a pool of processes.
+        # Only the text of the entries to extract is sent, and only a few batches 
+        # are in flight at any time to keep memory bounded. They are returned in 
+        # the order of the file
+        with multiprocessing.Pool(n_processes, initializer = _init_worker, initargs = (extractors,)) as pool:
+            pending = collections.deque()
+            batch = list()
+            for entry, uniref_ac, in_db in checked:
+                batch.append((uniref_ac, _entry_text(entry) if _wanted(uniref_ac, in_db, targets) else None))
+                if len(batch) == batch_size:
+                    pending.append(pool.apply_async(_extract_batch, (batch,)))
+                    batch = list()
+                    if len(pending) > 2*n_processes:
+                        yield from pending.popleft().get()
+            if len(batch) > 0:
+                pending.append(pool.apply_async(_extract_batch, (batch,)))
+
+            while len(pending) > 0:
+                yield from pending.popleft().get()
+
+    def _uniref_text_iterator(self, files, block_size = 1<<22):
+        # the text of all the files, in blocks. Each file is decoded on its own, and 
+        # made to end with a new line so that no row runs into the next file.
+        # Decoding whole blocks takes the ascii fast path of the utf-8 codec, a
+        # fraction of the time spent splitting the rows, so the extractors keep
+        # getting rows as str rather than bytes
         for f in files:
             if f.endswith('.gz'):
-                with gzip.open(f, 'rb') as fh:
-                    with io.TextIOWrapper(fh, encoding='utf-8') as decoder:
-                        for row in decoder:
-                            yield row.rstrip() 
+                blocks = _gz_blocks(f, block_size = block_size)
             else:
-                with open(f) as fh:
-                    for row in fh:
-                        yield row.rstrip()
+                blocks = self._file_blocks(f, block_size)
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            last = ''
+            for block in blocks:
+                text = decoder.decode(block)
+                if len(text) > 0:
+                    last = text
+                    yield text
+            text = decoder.decode(b'', final = True)
+            if len(text) > 0:
+                last = text
+                yield text
+            if len(last) > 0 and not last.endswith('\n'):
+                yield '\n'
+
+    @staticmethod
+    def _file_blocks(f, block_size):
+        with open(f, 'rb') as fh:
+            yield from iter(lambda: fh.read(block_size), b'')
 
     # functions to update uniprot and uniparc with darkness values
     def update_uniprot_and_uniparc(self, uniref_ac, entry_data, uniprot_db, uniparc_db, alphafold_db):
@@ -311,25 +832,34 @@ class uniref_extractor:
         uniref_data = {'UNIREF_AC': uniref_ac,  
                        'FULL_noDUF': entry_data['DARKNESS']['FULL_noDUF']}
         
-        uniprot_task_array = list()
-        uniparc_task_array = list()
-        alphfol_task_array = list()
-        
+        # the updates are collected over a whole chunk of entries, and written
+        # with one bulk_write per collection in flush_updates
         for ac in entry_data['ACC']:
             if ac.startswith('UP'):
-                uniparc_task_array.append(pymongo.UpdateOne({'_id': ac}, {'$set': {self.name: uniref_data}}))
+                self.uniparc_pending.append(pymongo.UpdateOne({'_id': ac}, {'$set': {self.name: uniref_data}}))
             else:
-                uniprot_task_array.append(pymongo.UpdateOne({'_id': ac}, {'$set': {self.name: uniref_data}}))
-                alphfol_task_array.append(pymongo.UpdateOne({'_id': ac}, {'$set': {self.name: uniref_data}}))
-                
-        if len(uniprot_task_array) > 0 and uniprot_db is not None:
-            uniprot_db.col.bulk_write(uniprot_task_array)
+                self.uniprot_pending.append(pymongo.UpdateOne({'_id': ac}, {'$set': {self.name: uniref_data}}))
+                self.af_pending.append(pymongo.UpdateOne({'_id': ac}, {'$set': {self.name: uniref_data}}))
+
+        self.n_pending += 1
+        if self.n_pending >= self.chunk_size:
+            self.flush_updates(uniprot_db, uniparc_db, alphafold_db)
 
-        if len(uniparc_task_array) > 0 and uniparc_db is not None:
-            uniparc_db.col.bulk_write(uniparc_task_array)
+    def flush_updates(self, uniprot_db, uniparc_db, alphafold_db):
+
+        if len(self.uniprot_pending) > 0 and uniprot_db is not None:
+            uniprot_db.col.bulk_write(self.uniprot_pending, ordered = False)
+
+        if len(self.uniparc_pending) > 0 and uniparc_db is not None:
+            uniparc_db.col.bulk_write(self.uniparc_pending, ordered = False)
         
-        if len(alphfol_task_array) > 0 and alphafold_db is not None:
-            alphafold_db.col.bulk_write(alphfol_task_array)
+        if len(self.af_pending) > 0 and alphafold_db is not None:
+            alphafold_db.col.bulk_write(self.af_pending, ordered = False)
+
+        self.uniprot_pending = list()
+        self.uniparc_pending = list()
+        self.af_pending = list()
+        self.n_pending = 0
         
         
 class ac_extractor(data_extractor_base):
@@ -350,10 +880,9 @@ class ac_extractor(data_extractor_base):
         :returns: The uniprot accession code, None if not found
         :rtype: :class:`str`
         """
-        for line in entry:
-            if line.startswith('<entry id='):
-                ac = line.split('="')[1].split('"')[0]
-                return ac
+        match = _AC_RE.search(_entry_text(entry))
+        if match is not None:
+            return match.group(1)
         return None
 
 class entries_extractor(data_extractor_base):
@@ -374,25 +903,21 @@ class entries_extractor(data_extractor_base):
         :returns: Cluster member entries, None if no entries found
         :rtype: :class:`list` of :class:`str`
         """
-        member_entries = list()
+        # a set from the start, the members are deduplicated while they are found
+        member_entries = set()
         search_uniprotid = False
-        for line in entry:
-            if line.startswith('<dbReference type='):
-                if 'UniProtKB' in line:
-                    # member = line.split('id=')[1].split('"')[1].split('_')[0]
-                    search_uniprotid = True
-                else:
-                    member = line.split('id=')[1].split('"')[1].split('"')[0]
-                    member_entries.append(member)	
-
-            elif line.startswith('<property type=') and search_uniprotid:
-                if 'UniProtKB' in line:
-                    member = line.split('value=')[1].split('"')[1]
-                    member_entries.append(member)
-                    search_uniprotid = False
+        for match in _MEMBER_RE.finditer(_entry_text(entry)):
+            if match.lastindex == 1:
+                # the accession comes with the first UniProtKB property that follows
+                search_uniprotid = True
+            elif match.lastindex == 2:
+                member_entries.add(match.group(2))
+            elif search_uniprotid:
+                member_entries.add(match.group(3))
+                search_uniprotid = False
 
         if len(member_entries) > 0:
-            return list(set(member_entries))
+            return list(member_entries)
         else:
             return None
 
@@ -415,23 +940,27 @@ class unirefs_extractor(data_extractor_base):
         :rtype: :class:`list` of :class:`str`
         """
         member_entries = {}
-        for line in entry:
-            if line.startswith('<property type='):
-                if 'UniRef' in line:
-                    member = line.split('value=')[1].split('"')[1]
-                    if member.split('_')[0] not in member_entries:
-                        member_entries[member.split('_')[0]] = []
-                        
-                    member_entries[member.split('_')[0]].append(member)
+        for member in _UNIREF_RE.findall(_entry_text(entry)):
+            uniref_level = member.split('_')[0]
+            if uniref_level not in member_entries:
+                member_entries[uniref_level] = set()
+            member_entries[uniref_level].add(member)
 
-        for uniref_level in member_entries:
-            member_entries[uniref_level] = list(set(member_entries[uniref_level]))
-            
         if len(member_entries) > 0:
-            return member_entries
+            return {uniref_level: list(members) for uniref_level, members in member_entries.items()}
         else:
             return None
 
+# the fields of the UniProt and UniParc documents needed to select the representative
+_REPRESENTATIVE_FIELDS = {'data.ANNOTCOV': 1, 'data.TM': 1, 'data.SP': 1}
+
+def _same_database(cols):
+    # whether all the collections are in the same database of the same server
+    try:
+        return all(col.database == cols[0].database for col in cols[1:])
+    except AttributeError:
+        return False
+
 class darkness_extractor(data_extractor_base):
     """Implements interface defined in :class:`data_extractor_base` and computes the coverage with annotations
      of an entry.
@@ -444,6 +973,9 @@ class darkness_extractor(data_extractor_base):
         """
         return 'DARKNESS'
 
+    # set to False if the server does not support $unionWith
+    use_union = True
+
     def extract(self, entry_uniref, uniprot_ac, uniprot_db, uniparc_db, alphafold_db):
         """Implements functionality defined in :func:`data_extractor_base.extract`
 
@@ -452,18 +984,54 @@ class darkness_extractor(data_extractor_base):
         """		
         uniprot_acs = entry_uniref['ACC']
 
-        self.uniprot_data   = uniprot_db.col.find({ '_id': { "$in": uniprot_acs }})
-        self.uniparc_data   = uniparc_db.col.find({ '_id': { "$in": uniprot_acs }})  
+        # only the fields used below are sent back, not the whole documents
+        queries = [(uniprot_db.col, _REPRESENTATIVE_FIELDS), (uniparc_db.col, _REPRESENTATIVE_FIELDS)]
+        if alphafold_db is not None:
+            queries.append((alphafold_db.col, {'data': 1}))
+
+        results = None
+        if self.use_union and _same_database([col for col, _ in queries]):
+            results = self._union_query(uniprot_acs, queries)
+        if results is None:
+            results = [col.find({ '_id': { "$in": uniprot_acs }}, fields) for col, fields in queries]
+
+        self.uniprot_data   = results[0]
+        self.uniparc_data   = results[1]
         self._select_representative()
 
         if alphafold_db is not None:
-            self.alphafold_data = alphafold_db.col.find({ '_id': { "$in": uniprot_acs }})
+            self.alphafold_data = results[2]
             self._add_alphafold_confidences()
 
         entry_uniref = self.register(entry_uniref)
 
         return entry_uniref
 
+    def _union_query(self, acs, queries):
+        # the documents of all the collections in a single aggregation, i.e. a
+        # single round trip to the server instead of one per collection. Each 
+        # document is tagged with the index of its collection, and the results are 
+        # split back. $unionWith needs MongoDB 4.4, with older servers we go back 
+        # to one find per collection for good
+        pipeline = None
+        for i, (col, fields) in enumerate(queries):
+            stages = [{'$match': {'_id': {'$in': acs}}}, 
+                      {'$project': fields}, 
+                      {'$addFields': {'_source': {'$literal': i}}}]
+            if pipeline is None:
+                pipeline = stages
+            else:
+                pipeline.append({'$unionWith': {'coll': col.name, 'pipeline': stages}})
+
+        results = [list() for _ in queries]
+        try:
+            for document in queries[0][0].aggregate(pipeline):
+                results[document.pop('_source')].append(document)
+        except pymongo.errors.OperationFailure:
+            self.use_union = False
+            return None
+        return results
+
     def _select_representative(self, parameter='FULL_noDUF'):
         self.full_coverage      = 0
         self.representative     = None
@@ -489,23 +1057,29 @@ class darkness_extractor(data_extractor_base):
         self.pLDDTs = []
         self.best_af2  = None
         self.worst_af2 = None
+        # the best and worst pLDDTs so far, instead of taking the max and min of
+        # all of them for every document
+        best_pLDDT  = None
+        worst_pLDDT = None
             
         for document in self.alphafold_data:
             ac   = document['_id']
             data = document['data']
             
-            avgPLDDT = []
+            sum_pLDDT = 0
             n_res = 0
             for fragment in data:
-                avgPLDDT.append(data[fragment]['pLDDT']['avg_pLDDT']*data[fragment]['pLDDT']['Lenght'])
+                sum_pLDDT += data[fragment]['pLDDT']['avg_pLDDT']*data[fragment]['pLDDT']['Lenght']
                 n_res += data[fragment]['pLDDT']['Lenght']
             
-            fullprotein_pLDDT = sum(avgPLDDT)/n_res            
-            if len(self.pLDDTs) == 0 or fullprotein_pLDDT > max(self.pLDDTs):
+            fullprotein_pLDDT = sum_pLDDT/n_res            
+            if best_pLDDT is None or fullprotein_pLDDT > best_pLDDT:
                 self.best_af2 = {'ACC': ac, 'LEN': n_res}
+                best_pLDDT = fullprotein_pLDDT
             
-            if len(self.pLDDTs) == 0 or fullprotein_pLDDT < min(self.pLDDTs):
+            if worst_pLDDT is None or fullprotein_pLDDT < worst_pLDDT:
                 self.worst_af2 = {'ACC': ac, 'LEN': n_res}
+                worst_pLDDT = fullprotein_pLDDT
             
             self.pLDDTs.append(fullprotein_pLDDT)
         